@@ -1,17 +1,41 @@
 # main.py (fix: SELECT uuid -> uid)
+import asyncio
 import logging
 import sqlite3
 import json
+import os
 import re
-from collections import defaultdict
+import sys
+import time
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import List, Dict, Any
-from fastapi import FastAPI
+from typing import List, Dict, Any, Optional, Tuple
+from fastapi import FastAPI, Response
 from pydantic import BaseModel
 import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
 from fastapi.middleware.cors import CORSMiddleware
+try:
+    import prometheus_client as prom
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:
+    prom = None
+
+sys.path.append(str(Path(__file__).resolve().parent / "script"))
+from faiss_utils import (
+    meta_path, read_index_meta, read_index, apply_index_params, make_search_params,
+    COMPRESSED_TYPES, fetch_stored_vectors, rescore, load_group_config, supports_id_selector,
+    read_transform, apply_transform, doc_index_path, search_ids_exact,
+)
+from chunk_store import STORE_PATH as CHUNK_STORE_PATH, fetch_texts, fetch_windows
+from keyword_index import search as keyword_search
+from keyword_matcher import KeywordMatcher
+from embedding_backend import load_backend, backend_spec
 
 app = FastAPI()
 app.add_middleware(
@@ -21,20 +45,552 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-MODEL_PATH = "/mydata/llm/vector/models/legal-bge-m3"
-model = SentenceTransformer(MODEL_PATH).to("cpu")
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
-logging.info(f"[INFO] 埋め込みモデル読み込み完了: {MODEL_PATH}")
 
-FAISS_INDEXES = {
-    "pdf_word": Path("/mydata/llm/vector/db/faiss/pdf_word/index.faiss"),
-    "excel_calendar": Path("/mydata/llm/vector/db/faiss/excel_calendar/index.faiss"),
+# === CPU処理用スレッドプール（torch / FAISS / SQLite はGILを解放する） ===
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", str(max(2, (os.cpu_count() or 4) - 2))))
+SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search")
+STAGE_LIMITS = {
+    "encode": int(os.getenv("STAGE_LIMIT_ENCODE", "1")),
+    "search": int(os.getenv("STAGE_LIMIT_SEARCH", str(SEARCH_WORKERS))),
+    "sqlite": int(os.getenv("STAGE_LIMIT_SQLITE", str(SEARCH_WORKERS))),
+    "text": int(os.getenv("STAGE_LIMIT_TEXT", str(SEARCH_WORKERS))),
+    "keyword": int(os.getenv("STAGE_LIMIT_KEYWORD", str(SEARCH_WORKERS))),
+    "rerank": int(os.getenv("STAGE_LIMIT_RERANK", str(SEARCH_WORKERS))),
+    "cross": int(os.getenv("STAGE_LIMIT_CROSS", "1")),
 }
-SQLITE_PATHS = {
-    "pdf_word": Path("/mydata/llm/vector/db/faiss/pdf_word/metadata.sqlite3"),
-    "excel_calendar": Path("/mydata/llm/vector/db/faiss/excel_calendar/metadata.sqlite3"),
+STAGE_SEMAPHORES = {stage: asyncio.Semaphore(max(1, n)) for stage, n in STAGE_LIMITS.items()}
+if os.getenv("FAISS_OMP_THREADS"):
+    faiss.omp_set_num_threads(int(os.getenv("FAISS_OMP_THREADS")))
+
+# === メトリクス（Prometheus 形式で /metrics に出す。prometheus_client がなければ計測しない） ===
+# 検索中は Histogram / Counter への加算だけ（1回数µs）。件数・世代・キャッシュはスクレイプ時に読む
+# プロセスの RSS・CPU時間は prometheus_client 既定の process_* に含まれる
+METRICS = prom is not None
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+if METRICS:
+    STAGE_SECONDS = prom.Histogram(
+        "vector_stage_seconds", "段階ごとの処理時間（stage: run_stage の段階 / step: 処理関数）",
+        ["stage", "step"], buckets=LATENCY_BUCKETS,
+    )
+    GROUP_SECONDS = prom.Histogram("vector_group_search_seconds", "グループ単位の検索時間", ["group"], buckets=LATENCY_BUCKETS)
+    ASSEMBLY_SECONDS = prom.Histogram("vector_context_assembly_seconds", "context_text の組み立て時間", buckets=LATENCY_BUCKETS)
+    REQUEST_SECONDS = prom.Histogram("vector_request_seconds", "/embed_search 全体の処理時間", buckets=LATENCY_BUCKETS)
+    REQUESTS = prom.Counter("vector_requests", "/embed_search の件数（result: hit / empty / cached）", ["result"])
+    GROUP_RESULTS = prom.Counter("vector_group_results", "グループ検索の件数（status: hit / empty / timeout / error）", ["group", "status"])
+    GROUP_HITS = prom.Counter("vector_group_hits", "グループ検索で返したチャンク数", ["group"])
+
+# explain=true のリクエストだけ段階ごとの時間・候補の内訳を集める（通常時は None のまま）
+_EXPLAIN: ContextVar[Optional[Dict[str, Any]]] = ContextVar("explain", default=None)
+
+def _release_soon(loop: asyncio.AbstractEventLoop, semaphore: asyncio.Semaphore, _job=None) -> None:
+    try:
+        loop.call_soon_threadsafe(semaphore.release)
+    except RuntimeError:
+        pass  # イベントループ終了後
+
+def _set_begun(begun: asyncio.Future) -> None:
+    if not begun.done():
+        begun.set_result(None)
+
+async def _submit_stage(stage: str, fn, args, kwargs, begun: Optional[asyncio.Future] = None):
+    """
+    段階の枠を取ってからスレッドプールに投げる。枠はスレッドの処理が終わった時に返す
+    （グループのタイムアウト等で呼び出し側が取り消しても、実行中の処理が終わるまで枠を使い続ける）
+    begun を渡すと、スレッドで処理が始まった時に完了する
+    """
+    semaphore = STAGE_SEMAPHORES[stage]
+    await semaphore.acquire()
+    loop = asyncio.get_running_loop()
+    target = partial(fn, *args, **kwargs)
+
+    def call():
+        if begun is not None:
+            loop.call_soon_threadsafe(_set_begun, begun)
+        return target()
+
+    try:
+        job = SEARCH_EXECUTOR.submit(call)
+    except BaseException:
+        semaphore.release()
+        raise
+    job.add_done_callback(partial(_release_soon, loop, semaphore))
+    return job
+
+def _record_stage(stage: str, fn, elapsed: float) -> None:
+    step = getattr(fn, "__name__", stage)
+    if METRICS:
+        STAGE_SECONDS.labels(stage, step).observe(elapsed)
+    trace = _EXPLAIN.get()
+    if trace is not None:
+        trace["stages"].append({"stage": stage, "step": step, "ms": round(elapsed * 1000, 2)})
+
+async def run_stage(stage: str, fn, *args, **kwargs):
+    """同期処理をスレッドプールで実行する（段階ごとに同時実行数を制限）"""
+    job = await _submit_stage(stage, fn, args, kwargs)
+    started = time.perf_counter()
+    try:
+        # 取り消された場合、まだ始まっていない処理はスレッドプールからも取り除かれる
+        return await asyncio.wrap_future(job)
+    finally:
+        _record_stage(stage, fn, time.perf_counter() - started)
+
+async def run_stage_budget(stage: str, budget_sec: float, fn, *args, **kwargs):
+    """
+    run_stage と同じだが、スレッドで処理が始まってから budget_sec 秒で打ち切る（asyncio.TimeoutError）
+    枠・スレッドプールの順番待ちは時間に含めない。打ち切っても実行中の処理は終わるまで枠を使い続ける
+    """
+    begun = asyncio.get_running_loop().create_future()
+    job = await _submit_stage(stage, fn, args, kwargs, begun)
+    started = time.perf_counter()
+    result = asyncio.wrap_future(job)
+    try:
+        await asyncio.wait({begun, result}, return_when=asyncio.FIRST_COMPLETED)
+        return await asyncio.wait_for(result, budget_sec)
+    finally:
+        if not result.done():
+            result.cancel()
+        _record_stage(stage, fn, time.perf_counter() - started)
+
+class LRUCache:
+    """件数上限つきLRU（ヒット／ミス数を記録）。ttl > 0 なら登録から ttl 秒で失効"""
+
+    def __init__(self, maxsize: int, ttl: float = 0.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._data: "OrderedDict[Any, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                value, expires_at = self._data[key]
+                if expires_at and expires_at < time.monotonic():
+                    del self._data[key]
+                    self.expired += 1
+                else:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value) -> None:
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl > 0 else 0.0
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl_sec": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+EMBED_CACHE = LRUCache(int(os.getenv("EMBED_CACHE_SIZE", "1024")))
+
+def _normalize_query(q: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", q).split())
+
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "16"))
+
+class EmbedBatcher:
+    """
+    同時に届いたクエリを短い待ち時間（window）の間に集め、1回の encode でまとめて処理する
+    encode 実行中に届いたクエリは次のバッチにまとめられる
+    待つのは他のクエリが待機中か encode 実行中（＝同時アクセス中）の場合だけで、単独のクエリはすぐ encode する
+    """
+
+    def __init__(self, encode_fn, window_ms: float = EMBED_BATCH_WINDOW_MS, max_batch: int = EMBED_BATCH_MAX):
+        self.encode_fn = encode_fn
+        self.window = max(0.0, window_ms) / 1000.0
+        self.max_batch = max(1, max_batch)
+        self.batches = 0
+        self.queries = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def _ensure_worker(self) -> asyncio.Queue:
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._worker.get_loop() is not loop:
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        return self._queue
+
+    async def encode(self, text: str) -> np.ndarray:
+        queue = self._ensure_worker()
+        fut = asyncio.get_running_loop().create_future()
+        await queue.put((text, fut))
+        return await fut
+
+    def _concurrent(self) -> bool:
+        return not self._queue.empty() or STAGE_SEMAPHORES["encode"].locked()
+
+    async def _run(self) -> None:
+        # 最初のクエリのコンテキストを引き継ぐため、explain の記録先を外す（複数リクエストをまとめて処理する）
+        _EXPLAIN.set(None)
+        while True:
+            batch = [await self._queue.get()]
+            if self.window > 0 and self.max_batch > 1 and self._concurrent():
+                await asyncio.sleep(self.window)
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            texts = list(dict.fromkeys(t for t, _ in batch))
+            try:
+                embeddings = await run_stage("encode", self.encode_fn, texts)
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            self.batches += 1
+            self.queries += len(batch)
+            rows = {t: embeddings[i:i + 1] for i, t in enumerate(texts)}
+            for t, fut in batch:
+                if not fut.done():
+                    fut.set_result(rows[t])
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "window_ms": self.window * 1000.0,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "queries": self.queries,
+            "avg_batch_size": round(self.queries / self.batches, 2) if self.batches else 0.0,
+        }
+
+async def encode_query(query: str, embedder) -> np.ndarray:
+    """クエリ埋め込み（正規化済みクエリ＋バックエンド名をキーにキャッシュ）"""
+    key = (embedder.name, _normalize_query(query))
+    cached = EMBED_CACHE.get(key)
+    if cached is not None:
+        return cached
+    embedding = np.array(await EMBED_BATCHERS[embedder.name].encode(key[1]))
+    embedding.setflags(write=False)
+    EMBED_CACHE.put(key, embedding)
+    return embedding
+
+# === 検索グループ（新しいグループはここに追加すると並列検索の対象になる） ===
+# types          : チャンクの type（キーワード検索の絞り込み）
+# rerank         : rerank_candidates の引数
+# expand_top     : 上位何件に前後の文脈を付けるか
+# context_window : 前後何チャンクまで付けるか（vector_config_vector_<group>.json の "context_window" で上書き）
+# doc_top_k      : 先に文書単位（uid ごとの重心）で検索し、上位何文書のチャンクに絞るか（0 = 使わない。"doc_top_k" で上書き）
+GROUPS: Dict[str, Dict[str, Any]] = {
+    "pdf_word": {
+        "types": ("pdf", "word"),
+        "rerank": {"use_adjacency": True, "final_topk": 6, "weights": (0.6, 0.3, 0.1)},
+        "expand_top": 3,
+        "context_window": 1,
+        "doc_top_k": 0,
+    },
+    "excel_calendar": {
+        "types": ("excel", "calendar"),
+        "rerank": {"use_adjacency": False, "final_topk": 15, "weights": (0.7, 0.3, 0.0)},
+        "expand_top": 15,
+        "context_window": 0,
+        "doc_top_k": 20,   # 1ファイルで数百行が似たベクトルになり、上位を1ファイルが占めるため
+    },
 }
+FAISS_INDEXES = {group: Path(f"/mydata/llm/vector/db/faiss/{group}/index.faiss") for group in GROUPS}
+SQLITE_PATHS = {group: Path(f"/mydata/llm/vector/db/faiss/{group}/metadata.sqlite3") for group in GROUPS}
 CHUNK_DIR = Path("/mydata/llm/vector/db/chunk")
+GROUP_TYPES = {group: conf["types"] for group, conf in GROUPS.items()}
+CONTEXT_WINDOWS = {
+    group: int(load_group_config(group).get("context_window", conf["context_window"]))
+    for group, conf in GROUPS.items()
+}
+DOC_TOP_K = {
+    group: int(load_group_config(group).get("doc_top_k", conf["doc_top_k"]))
+    for group, conf in GROUPS.items()
+}
+
+# === クエリ埋め込み（グループごと） ===
+# ベクトル登録側（make_vector_<group>.py）と同じ vector_config_vector_<group>.json の embedding_backend で埋め込む
+# 同じ設定のグループはモデル・バッチ処理・埋め込みキャッシュ（キーはバックエンド名）を共用する
+def _load_group_embedders() -> Dict[str, Any]:
+    """グループ → 埋め込みバックエンド（同じ設定のグループは1つを共用）"""
+    loaded: Dict[Tuple[str, str, str], Any] = {}
+    embedders = {}
+    for group in GROUPS:
+        spec = backend_spec(load_group_config(group))
+        if spec not in loaded:
+            loaded[spec] = load_backend(*spec)
+            logging.info(f"[INFO] 埋め込みモデル読み込み完了: {loaded[spec].name}")
+        embedders[group] = loaded[spec]
+    return embedders
+
+GROUP_EMBEDDERS = _load_group_embedders()
+EMBEDDERS = {e.name: e for e in GROUP_EMBEDDERS.values()}
+EMBED_BATCHERS = {name: EmbedBatcher(e.encode) for name, e in EMBEDDERS.items()}
+
+DOC_MAX_CHUNKS = int(os.getenv("DOC_MAX_CHUNKS", "5"))  # 文書単位で絞った場合の1文書あたり最大チャンク数
+GROUP_TIMEOUT_SEC = float(os.getenv("GROUP_TIMEOUT_SEC", "5.0"))  # 超えたグループは結果なしで応答する
+
+INDEX_CHECK_INTERVAL_SEC = float(os.getenv("INDEX_CHECK_INTERVAL_SEC", "2.0"))
+FAISS_MMAP = os.getenv("FAISS_MMAP", "1") == "1"  # 複数プロセスでページキャッシュを共有
+
+class IndexCache:
+    """
+    FAISSインデックスを常駐させ、index.meta.json（世代マーカー）が変わった時だけ読み直す
+    差し替えは参照の付け替えのみなので、検索中のリクエストは旧インデックスのまま完了する
+    """
+
+    def __init__(
+        self, paths: Dict[str, Path], check_interval: float = INDEX_CHECK_INTERVAL_SEC,
+        with_transform: bool = True, label: str = "",
+    ):
+        self.paths = paths
+        self.check_interval = check_interval
+        self.with_transform = with_transform  # 文書インデックスは元の次元のまま（次元削減は使わない）
+        self.label = label
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._checked_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _signature(self, group: str) -> Optional[Tuple[int, int, int]]:
+        index_path = self.paths[group]
+        try:
+            st = index_path.stat()
+        except FileNotFoundError:
+            return None
+        try:
+            meta_mtime = meta_path(index_path).stat().st_mtime_ns
+        except FileNotFoundError:
+            meta_mtime = 0
+        return (meta_mtime, st.st_mtime_ns, st.st_size)
+
+    def _load(self, group: str, signature: Tuple[int, int, int]) -> Dict[str, Any]:
+        index_path = self.paths[group]
+        started = time.perf_counter()
+        index, mmapped = read_index(index_path, mmap=FAISS_MMAP)
+        transform = read_transform(index_path) if self.with_transform else None
+        if transform is not None and transform.d_out != index.d:
+            # 書き換え途中（変換行列とインデックスの世代が揃っていない）→ 旧インデックスのまま次回読み直す
+            raise ValueError(f"次元削減({transform.d_out})とインデックス({index.d})の次元が一致しません")
+        meta = read_index_meta(index_path)
+        apply_index_params(index, meta)
+        embedder = GROUP_EMBEDDERS[group]
+        if meta.get("embedding_backend", embedder.name) != embedder.name:
+            logging.warning(
+                f"[WARN] 埋め込みバックエンド不一致: {group} インデックス={meta['embedding_backend']} / 検索={embedder.name}"
+            )
+        logging.info(
+            f"[INFO] FAISS読込: {group}{self.label} 世代={meta.get('generation', 0)} 件数={index.ntotal} "
+            f"次元={index.d}{'（' + meta.get('reduce', '') + '）' if transform is not None else ''} "
+            f"{'mmap(' + mmapped + ')' if mmapped else 'メモリ展開'} ({time.perf_counter() - started:.2f}秒)"
+        )
+        return {
+            "index": index,
+            "transform": transform,
+            "signature": signature,
+            "generation": int(meta.get("generation", 0)),
+            "index_type": meta.get("index_type", "flat"),
+            "mmap": mmapped,
+            "embedding_backend": meta.get("embedding_backend", ""),
+            # 圧縮インデックス・次元削減は近似スコアのため再採点する（meta に倍率が残っている）
+            "rescore_factor": int(meta.get("rescore_factor", 4 if meta.get("index_type") in COMPRESSED_TYPES else 0)),
+            "rescore_candidates": int(meta.get("rescore_candidates", 0)),
+        }
+
+    def refresh(self, group: str) -> Optional[Dict[str, Any]]:
+        signature = self._signature(group)
+        current = self._entries.get(group)
+        if signature is None:
+            if current is not None:
+                logging.info(f"[INFO] FAISS解放（ファイル削除）: {group}{self.label}")
+                self._entries.pop(group, None)
+            return None
+        if current is not None and current["signature"] == signature:
+            return current
+        with self._lock:
+            current = self._entries.get(group)
+            if current is not None and current["signature"] == signature:
+                return current
+            try:
+                entry = self._load(group, signature)
+            except Exception as e:
+                logging.error(f"[ERROR] FAISS読込失敗: {group}{self.label} → {e}")
+                return current
+            self._entries[group] = entry
+            return entry
+
+    def peek(self, group: str) -> Optional[Dict[str, Any]]:
+        """読み直しの確認をせずに現在のエントリを返す（イベントループ上・メトリクス用）"""
+        return self._entries.get(group)
+
+    def get(self, group: str) -> Optional[Dict[str, Any]]:
+        now = time.monotonic()
+        if now - self._checked_at.get(group, 0.0) < self.check_interval:
+            return self._entries.get(group)
+        self._checked_at[group] = now
+        return self.refresh(group)
+
+    def check_in_background(self, executor: ThreadPoolExecutor) -> None:
+        """確認間隔を過ぎたグループの読み直し確認をスレッドプールに投げる（イベントループ上から呼ぶ。完了は待たない）"""
+        now = time.monotonic()
+        for group in self.paths:
+            if now - self._checked_at.get(group, 0.0) >= self.check_interval:
+                self._checked_at[group] = now
+                executor.submit(self.refresh, group)
+
+    def refresh_all(self) -> None:
+        for group in self.paths:
+            self._checked_at[group] = time.monotonic()
+            self.refresh(group)
+
+INDEX_CACHE = IndexCache(FAISS_INDEXES)
+INDEX_CACHE.refresh_all()
+# 文書単位インデックス（doc_top_k > 0 のグループのみ）。世代は index.meta.json を共有する
+DOC_INDEX_CACHE = IndexCache(
+    {group: doc_index_path(path) for group, path in FAISS_INDEXES.items() if DOC_TOP_K[group] > 0},
+    with_transform=False, label="（文書）",
+)
+DOC_INDEX_CACHE.refresh_all()
+
+# === 検索結果キャッシュ（再生成・再送で同じリクエストが来た場合） ===
+# キーに各グループのインデックス世代を含めるため、ベクトル登録で世代が進めば自然に無効になる
+RESULT_CACHE = LRUCache(
+    int(os.getenv("RESULT_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("RESULT_CACHE_TTL_SEC", "600")),
+)
+
+def index_generations() -> Tuple[int, ...]:
+    """読み込み済みの世代（イベントループ上で呼ぶため読み直しはしない。読み直しはスレッドプール側で行う）"""
+    generations = []
+    for group in GROUPS:
+        entry = INDEX_CACHE.peek(group)
+        generations.append(entry["generation"] if entry is not None else -1)
+    return tuple(generations)
+
+def check_indexes() -> None:
+    """検索結果キャッシュに当たり続けても更新に気づけるよう、リクエストごとに世代の確認を予約する"""
+    INDEX_CACHE.check_in_background(SEARCH_EXECUTOR)
+    DOC_INDEX_CACHE.check_in_background(SEARCH_EXECUTOR)
+
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+_DB_LOCAL = threading.local()
+
+def _get_readonly_conn(path: Path) -> sqlite3.Connection:
+    """読み取り専用接続をスレッドごとに使い回す（mmap + ステートメントキャッシュ付き）"""
+    conns = getattr(_DB_LOCAL, "conns", None)
+    if conns is None:
+        conns = _DB_LOCAL.conns = {}
+    conn = conns.get(str(path))
+    if conn is None:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, cached_statements=256)
+        conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        conn.execute("PRAGMA query_only=ON")
+        conns[str(path)] = conn
+    return conn
+
+def fetch_metadata(sqlite_path: Path, vec_indexes: List[int]) -> Dict[int, Tuple[str, int, str, str]]:
+    """vec_index → (uid, chunk_index, path, type) を1クエリでまとめて引く"""
+    if not vec_indexes:
+        return {}
+    conn = _get_readonly_conn(sqlite_path)
+    rows = conn.execute(
+        "SELECT vec_index, uid, chunk_index, path, type FROM vector_metadata "
+        "WHERE vec_index IN (SELECT value FROM json_each(?))",
+        (json.dumps(vec_indexes),),
+    ).fetchall()
+    return {int(r[0]): (r[1], int(r[2]), r[3], r[4]) for r in rows}
+
+def fetch_vectors_by_keys(sqlite_path: Path, keys: List[Tuple[str, int]]) -> Dict[Tuple[str, int], Tuple[int, np.ndarray]]:
+    """(path, chunk_index) → (vec_index, 保存済みベクトル)"""
+    if not keys:
+        return {}
+    conn = _get_readonly_conn(sqlite_path)
+    rows = conn.execute(
+        """
+        SELECT m.path, m.chunk_index, m.vec_index, m.vector
+        FROM json_each(?) AS k
+        JOIN vector_metadata AS m
+          ON m.path = json_extract(k.value, '$[0]')
+         AND m.chunk_index = json_extract(k.value, '$[1]')
+        """,
+        (json.dumps([[p, int(i)] for p, i in keys], ensure_ascii=False),),
+    ).fetchall()
+    return {(p, int(i)): (int(v), np.frombuffer(b, dtype=np.float32)) for p, i, v, b in rows}
+
+# === キーワード検索レーン（文字bigram転置インデックス + BM25） ===
+KEYWORD_SEARCH = os.getenv("KEYWORD_SEARCH", "1") == "1"
+# keywords 未指定時の語: ひらがな（助詞・活用語尾）で区切った漢字・カタカナ・英数字の連続
+# （ひらがなを含めると質問文全体が1語になり、FTS のフレーズとしてほぼ一致しない）
+LANE_TOKEN = re.compile(r"[ァ-ヶー一-龥々〆A-Za-z0-9]+")
+BM25_TOP_K = int(os.getenv("BM25_TOP_K", "50"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+def lane_keywords_from_query(q: str, limit: int = 12) -> List[str]:
+    toks = [t for t in LANE_TOKEN.findall(unicodedata.normalize("NFKC", q)) if len(t) >= 2]
+    return list(dict.fromkeys(toks))[:limit]
+
+def keyword_hits(
+    db_group: str, sqlite_path: Path, keywords: List[str], embedding: np.ndarray, k: int,
+    types: Tuple[str, ...] = (), path_prefix: Optional[str] = None, allowed_ids: Optional[np.ndarray] = None,
+) -> List[Dict[str, Any]]:
+    """
+    BM25 上位をチャンクストアから取り、FAISS と同じ尺度の score（保存済みベクトルとの内積）を付ける
+    絞り込み時は types / path_prefix を検索条件に入れ、allowed_ids（昇順の vec_index）外のヒットは捨てる
+    """
+    if not keywords or not CHUNK_STORE_PATH.exists():
+        return []
+    try:
+        hits = keyword_search(
+            _get_readonly_conn(CHUNK_STORE_PATH), keywords, types or GROUP_TYPES[db_group], k,
+            path_prefix=path_prefix,
+        )
+    except sqlite3.OperationalError as e:
+        logging.warning(f"[WARN] キーワード検索不可: {e}")
+        return []
+    vectors = fetch_vectors_by_keys(sqlite_path, [(h["path"], h["chunk_index"]) for h in hits])
+    out = []
+    for h in hits:
+        found = vectors.get((h["path"], h["chunk_index"]))
+        if found is None or not h["text"].strip():
+            continue  # 未ベクトル化のチャンク
+        vec_index, vector = found
+        if allowed_ids is not None and not _contains_sorted(allowed_ids, vec_index):
+            continue
+        h.update(vec_index=vec_index, score=float(vector @ embedding[0]), source=db_group)
+        out.append(h)
+    return out
+
+def fuse_hits(dense: List[Dict[str, Any]], keyword: List[Dict[str, Any]], limit: int) -> List[Dict[str, Any]]:
+    """FAISS 順位と BM25 順位の Reciprocal Rank Fusion。上位 limit 件を返す"""
+    if not keyword:
+        return dense
+    fused: Dict[Tuple[str, int], Dict[str, Any]] = {}
+    for rank, h in enumerate(dense):
+        h["rrf"] = 1.0 / (RRF_K + rank + 1)
+        fused[(h["path"], h["chunk_index"])] = h
+    for rank, h in enumerate(keyword):
+        key = (h["path"], h["chunk_index"])
+        if key in fused:
+            fused[key]["rrf"] += 1.0 / (RRF_K + rank + 1)
+            fused[key]["bm25"] = h["bm25"]
+        else:
+            h["rrf"] = 1.0 / (RRF_K + rank + 1)
+            fused[key] = h
+    return sorted(fused.values(), key=lambda x: -x["rrf"])[:limit]
 
 JP_TOKEN = re.compile(r"[ぁ-んァ-ン一-龥A-Za-z0-9]+")
 
@@ -46,32 +602,58 @@ def _build_bigrams(words: List[str]) -> List[str]:
     ws = [w for w in words if w]
     return ["".join(p) for p in zip(ws, ws[1:])]
 
-def _keyword_score(text: str, kws: List[str], bigrams: List[str]) -> float:
+def _keyword_scores(texts: List[str], kws: List[str], bigrams: List[str]) -> np.ndarray:
+    """キーワード一致率 + bigram ボーナス。キーワードと bigram を1つのオートマトンにし、各本文は1回だけ走査"""
+    scores = np.zeros(len(texts))
     if not kws:
-        return 0.0
-    hit = sum(1 for k in kws if k and k in text)
-    base = hit / max(1, len(kws))
-    bigram_bonus = 0.2 if any(b and b in text for b in bigrams) else 0.0
-    return min(1.0, base + bigram_bonus)
-
-def _compute_adjacency_bonus(cands: List[Dict[str, Any]]) -> List[float]:
-    by_doc = defaultdict(list)
-    for i, c in enumerate(cands):
-        by_doc[c["path"]].append((i, c["chunk_index"], c.get("_base", 0.0)))
-    bonus = [0.0] * len(cands)
-    for items in by_doc.values():
-        items.sort(key=lambda x: x[1])
-        for j, (i_idx, idx, bscore) in enumerate(items):
-            for k in (-2, -1, 1, 2):
-                jj = j + k
-                if 0 <= jj < len(items):
-                    _, idx2, b2 = items[jj]
-                    if abs(idx2 - idx) == 1 and b2 >= 0.55:
-                        bonus[i_idx] = max(bonus[i_idx], 0.15)
-                    elif abs(idx2 - idx) == 2 and b2 >= 0.60:
-                        bonus[i_idx] = max(bonus[i_idx], 0.10)
+        return scores
+    matcher = KeywordMatcher(kws + bigrams)
+    kw_counts = Counter(k for k in kws if k)
+    bigram_set = {b for b in bigrams if b}
+    for i, text in enumerate(texts):
+        found = matcher.matches(text)
+        if not found:
+            continue
+        hit = sum(kw_counts[k] for k in found if k in kw_counts)
+        bigram_bonus = 0.2 if not found.isdisjoint(bigram_set) else 0.0
+        scores[i] = min(1.0, hit / len(kws) + bigram_bonus)
+    return scores
+
+def _compute_adjacency_bonus(path_ids: np.ndarray, chunk_idx: np.ndarray, base: np.ndarray) -> np.ndarray:
+    """
+    同じ文書内で隣（±1）／1つ飛び（±2）のチャンクも高スコアなら加点する
+    (path, chunk_index) 順に並べ、前後2つ以内の位置だけを比較する
+    """
+    n = len(base)
+    bonus = np.zeros(n)
+    if n < 2:
+        return bonus
+    order = np.lexsort((chunk_idx, path_ids))
+    p, ci, b = path_ids[order], chunk_idx[order], base[order]
+    sorted_bonus = np.zeros(n)
+    for shift in (1, 2):
+        if shift >= n:
+            break
+        same = p[shift:] == p[:-shift]
+        gap = np.abs(ci[shift:] - ci[:-shift])
+        for dist, thr, val in ((1, 0.55, 0.15), (2, 0.60, 0.10)):
+            near = same & (gap == dist)
+            # 後ろの要素 ← 前の要素のスコア / 前の要素 ← 後ろの要素のスコア
+            sorted_bonus[shift:] = np.maximum(sorted_bonus[shift:], np.where(near & (b[:-shift] >= thr), val, 0.0))
+            sorted_bonus[:-shift] = np.maximum(sorted_bonus[:-shift], np.where(near & (b[shift:] >= thr), val, 0.0))
+    bonus[order] = sorted_bonus
     return bonus
 
+def _top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """スコア降順の上位 k 件（同点は元の順）。argpartition で候補を絞ってから並べる"""
+    n = len(scores)
+    if k < n:
+        thr = scores[np.argpartition(-scores, k - 1)[:k]].min()
+        cand = np.flatnonzero(scores >= thr)
+    else:
+        cand = np.arange(n)
+    return cand[np.lexsort((cand, -scores[cand]))][:k]
+
 def _extract_keywords_from_query(q: str, limit=12) -> List[str]:
     toks = [t for t in JP_TOKEN.findall(q) if len(t) >= 2]
     seen, out = set(), []
@@ -88,56 +670,220 @@ def rerank_candidates(
     use_adjacency: bool = False,
     final_topk: int = 8,
     weights=(0.6, 0.3, 0.1),
+    explain: Optional[Dict[str, Any]] = None,
 ) -> List[Dict[str, Any]]:
+    """explain: dict を渡すと全候補のスコア内訳（ゲート通過・重複除外・順位）を書き込む"""
     if not base_candidates:
         return []
     kws = given_keywords or []
     if not kws:
         kws = _extract_keywords_from_query(query)
     bigrams = _build_bigrams(kws)
+    n = len(base_candidates)
+
+    # 候補を列（配列）で持つ
+    path_codes: Dict[str, int] = {}
+    path_ids = np.fromiter((path_codes.setdefault(c["path"], len(path_codes)) for c in base_candidates), np.int64, n)
+    chunk_idx = np.fromiter((int(c["chunk_index"]) for c in base_candidates), np.int64, n)
+    scores = np.fromiter((float(c["score"]) for c in base_candidates), np.float64, n)
+    kw = _keyword_scores([c["text"] for c in base_candidates], kws, bigrams)
 
     w_embed, w_kw, w_adj = weights
-    gated: List[Dict[str, Any]] = []
-    for c in base_candidates:
-        kw = _keyword_score(c["text"], kws, bigrams)
-        if kw > 0.0 or c["score"] >= 0.80:
-            c["_embed"] = _normalize_score(c["score"])
-            c["_kw"] = kw
-            c["_base"] = w_embed * c["_embed"] + w_kw * c["_kw"]
-            gated.append(c)
-
-    if not gated:
-        gated = base_candidates[:]
-
-    adj_bonus = [0.0] * len(gated)
-    if use_adjacency:
-        adj_bonus = _compute_adjacency_bonus(gated)
+    embed = (np.clip(scores, 0.5, 0.9) - 0.5) / (0.9 - 0.5)
+    base = w_embed * embed + w_kw * kw
 
-    for c, bn in zip(gated, adj_bonus):
-        c["_adj"] = bn if use_adjacency else 0.0
-        c["_rerank"] = c["_base"] + w_adj * c["_adj"]
+    gated = np.flatnonzero((kw > 0.0) | (scores >= 0.80))
+    gate_fallback = len(gated) == 0
+    if gate_fallback:
+        gated = np.arange(n)
+    path_ids, chunk_idx, base = path_ids[gated], chunk_idx[gated], base[gated]
 
-    seen_pi = set()
-    uniq = []
-    for c in sorted(gated, key=lambda x: x["_rerank"], reverse=True):
-        key = (c["path"], c["chunk_index"])
-        if key in seen_pi:
-            continue
-        seen_pi.add(key)
-        c["adjusted_score"] = round(float(c["_rerank"]), 4)
-        for k in ("_embed","_kw","_base","_adj","_rerank"):
-            c.pop(k, None)
-        uniq.append(c)
-        if len(uniq) >= max(1, final_topk):
-            break
-    return uniq
+    rerank = base
+    adjacency = None
+    if use_adjacency:
+        adjacency = _compute_adjacency_bonus(path_ids, chunk_idx, base)
+        rerank = base + w_adj * adjacency
+
+    # 同じ (path, chunk_index) は最高スコアの1件だけ残す
+    keys = path_ids * (int(chunk_idx.max()) + 1) + chunk_idx if len(chunk_idx) else chunk_idx
+    pos = np.arange(len(keys))
+    order = np.lexsort((pos, -rerank, keys))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = keys[order][1:] != keys[order][:-1]
+    uniq = np.sort(order[first])
+
+    top = uniq[_top_k_indices(rerank[uniq], max(1, final_topk))]
+    out = []
+    for i in top:
+        c = base_candidates[int(gated[i])]
+        c["adjusted_score"] = round(float(rerank[i]), 4)
+        out.append(c)
+    if explain is not None:
+        _explain_rerank(explain, base_candidates, scores, embed, kw, gated, gate_fallback, adjacency, rerank, uniq, top)
+    return out
+
+def _explain_rerank(
+    explain: Dict[str, Any], base_candidates: List[Dict[str, Any]], scores: np.ndarray, embed: np.ndarray,
+    kw: np.ndarray, gated: np.ndarray, gate_fallback: bool, adjacency: Optional[np.ndarray],
+    rerank: np.ndarray, uniq: np.ndarray, top: np.ndarray,
+) -> None:
+    """rerank_candidates の途中の配列から、候補ごとの内訳を作る（explain=true のときだけ呼ばれる）"""
+    pos = {int(g): i for i, g in enumerate(gated)}  # 候補番号 → ゲート後の位置
+    kept = {int(i) for i in uniq}
+    rank = {int(i): r for r, i in enumerate(top)}
+    rows = []
+    for j, c in enumerate(base_candidates):
+        i = pos.get(j)
+        rows.append({
+            "path": c["path"],
+            "chunk_index": int(c["chunk_index"]),
+            "vec_index": c.get("vec_index"),
+            "faiss_score": round(float(scores[j]), 4),
+            "bm25": c.get("bm25"),
+            "rrf": round(c["rrf"], 5) if "rrf" in c else None,
+            "embed_norm": round(float(embed[j]), 4),
+            "keyword_score": round(float(kw[j]), 4),
+            "gated": i is not None,
+            "adjacency_bonus": round(float(adjacency[i]), 4) if adjacency is not None and i is not None else 0.0,
+            "rerank_score": round(float(rerank[i]), 4) if i is not None else None,
+            "duplicate": i is not None and i not in kept,
+            "rerank_rank": rank.get(i) if i is not None else None,
+        })
+    explain["gate_fallback"] = gate_fallback
+    explain["candidates"] = rows
 
 class EmbedRequest(BaseModel):
     query: str
     top_k: int = 30
     keywords: List[str] = []
-
-def load_chunk_text(path: str, index: int) -> str:
+    hybrid: bool = True               # キーワード転置インデックス（BM25）の結果も融合する
+    nprobe: Optional[int] = None      # IVF: 検索するセントロイド数（未指定は index.meta.json の値）
+    ef_search: Optional[int] = None   # HNSW: 探索幅（同上）
+    # 絞り込み（検索前に vec_index の集合にしてから FAISS を引く）
+    types: List[str] = []             # チャンク種別（pdf / word / excel / calendar）
+    path_prefix: Optional[str] = None # パス前方一致（例: "顧客/A社/"）
+    mtime_from: Optional[float] = None  # 元ファイル更新日時（UNIX秒）の下限
+    mtime_to: Optional[float] = None    # 同上限
+    max_context_tokens: Optional[int] = None  # 文脈のトークン上限（未指定は MAX_CONTEXT_TOKENS、0 は無制限）
+    cross_encoder: bool = True        # CROSS_ENCODER_PATH 設定時にクロスエンコーダーで並べ直す
+    explain: bool = False             # 候補ごとのスコア内訳と段階ごとの時間を返す（キャッシュは使わない）
+
+    def has_filters(self) -> bool:
+        return bool(self.types or self.path_prefix or self.mtime_from is not None or self.mtime_to is not None)
+
+# === 絞り込み検索 ===
+# flat / IVF-Flat / HNSW-Flat はインデックス内の float ベクトルを IDSelector で全件採点する（件数によらない）
+# 圧縮・次元削減インデックスは、件数が FILTER_EXACT_MAX 以下なら SQLite の保存済みベクトルで全件採点し、
+# それより多ければ FAISS に IDSelector を渡して近似検索してから再採点する
+FILTER_EXACT_MAX = int(os.getenv("FILTER_EXACT_MAX", "2000"))
+FILTER_CACHE = LRUCache(int(os.getenv("FILTER_CACHE_SIZE", "64")))
+
+def _contains_sorted(sorted_ids: np.ndarray, value: int) -> bool:
+    pos = int(np.searchsorted(sorted_ids, value))
+    return pos < len(sorted_ids) and int(sorted_ids[pos]) == value
+
+def resolve_filter_ids(
+    db_group: str, sqlite_path: Path, types: Tuple[str, ...], path_prefix: Optional[str],
+    mtime_from: Optional[float], mtime_to: Optional[float],
+) -> np.ndarray:
+    """絞り込み条件 → vec_index（昇順）。idx_vector_metadata_filter だけで引けるのでベクトルBLOBは読まない"""
+    entry = INDEX_CACHE.get(db_group)
+    key = (db_group, entry["generation"] if entry else -1, types, path_prefix, mtime_from, mtime_to)
+    cached = FILTER_CACHE.get(key)
+    if cached is not None:
+        return cached
+    clauses = ["type IN (SELECT value FROM json_each(?))"]
+    params: List[Any] = [json.dumps(list(types))]
+    if path_prefix:
+        clauses.append("path >= ? AND path < ?")
+        params += [path_prefix, path_prefix + "\U0010ffff"]
+    if mtime_from is not None:
+        clauses.append("mtime >= ?")
+        params.append(float(mtime_from))
+    if mtime_to is not None:
+        clauses.append("mtime <= ?")
+        params.append(float(mtime_to))
+    rows = _get_readonly_conn(sqlite_path).execute(
+        f"SELECT vec_index FROM vector_metadata WHERE {' AND '.join(clauses)} ORDER BY vec_index", params
+    ).fetchall()
+    ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+    ids.setflags(write=False)
+    FILTER_CACHE.put(key, ids)
+    return ids
+
+def _exact_search(sqlite_path: Path, embedding: np.ndarray, ids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """絞り込み後の少数件を保存済みベクトルで全件採点"""
+    stored = fetch_stored_vectors(_get_readonly_conn(sqlite_path), ids)
+    return rescore(embedding[0], ids, stored, k)
+
+def resolve_doc_ids(db_group: str, sqlite_path: Path, embedding: np.ndarray, doc_top_k: int) -> Optional[np.ndarray]:
+    """文書インデックスで上位 doc_top_k 文書を選び、そのチャンクの vec_index（昇順）を返す。文書インデックスがなければ None"""
+    entry = DOC_INDEX_CACHE.get(db_group)
+    if entry is None:
+        return None
+    _, I = entry["index"].search(embedding, doc_top_k)
+    doc_ids = [int(d) for d in I[0] if d != -1]
+    rows = _get_readonly_conn(sqlite_path).execute(
+        """
+        SELECT m.vec_index
+        FROM doc_centroids AS d
+        JOIN vector_metadata AS m ON m.uid = d.uid
+        WHERE d.doc_id IN (SELECT value FROM json_each(?))
+        ORDER BY m.vec_index
+        """,
+        (json.dumps(doc_ids),),
+    ).fetchall()
+    return np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+
+def _cap_per_doc(rows: List[Tuple[float, int, Tuple[str, int, str, str]]], cap: int) -> List[Tuple[float, int, Tuple[str, int, str, str]]]:
+    """スコア順の (score, vec_index, メタデータ) を1文書（uid）あたり cap 件までに間引く"""
+    counts: Counter = Counter()
+    kept = []
+    for row in rows:
+        uid = row[2][0]
+        if counts[uid] < cap:
+            counts[uid] += 1
+            kept.append(row)
+    return kept
+
+def _faiss_search(
+    db_group: str, embedding: np.ndarray, k: int,
+    nprobe: Optional[int] = None, ef_search: Optional[int] = None, ids: Optional[np.ndarray] = None,
+) -> Optional[Tuple[np.ndarray, np.ndarray, int, bool]]:
+    """
+    戻り値: (D, I, 再採点倍率, 全件採点か)。圧縮インデックス・次元削減は k × 倍率 件
+    （binary は最低 binary_candidates 件）を返す。ids 指定時はその中だけを検索
+    （float のままのインデックスは FAISS 内で全件採点、それ以外は FILTER_EXACT_MAX 件以下か
+    IDSelector 非対応なら保存済みベクトルで全件採点する）
+    次元削減ありのグループはクエリにも同じ変換をかける（再採点は元の次元のまま）
+    """
+    entry = INDEX_CACHE.get(db_group)
+    if entry is None:
+        return None
+    index = entry["index"]
+    if ids is not None and entry["transform"] is None:
+        hits = search_ids_exact(index, embedding, ids, k)
+        if hits is not None:
+            return hits[0], hits[1], 0, True
+    if ids is not None and (len(ids) <= FILTER_EXACT_MAX or not supports_id_selector(index)):
+        D, I = _exact_search(SQLITE_PATHS[db_group], embedding, ids, k)
+        return D, I, 0, True
+    embedding = apply_transform(entry["transform"], embedding)
+    factor = entry["rescore_factor"]
+    k_eff = max(k * factor, entry["rescore_candidates"]) if factor else k
+    sel = faiss.IDSelectorBatch(ids) if ids is not None else None
+    params = make_search_params(index, nprobe=nprobe, ef_search=ef_search, sel=sel)
+    if params is None:
+        D, I = index.search(embedding, k_eff)
+    else:
+        D, I = index.search(embedding, k_eff, params=params)
+    return D, I, factor, False
+
+def _rescore_hits(sqlite_path: Path, embedding: np.ndarray, I: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    stored = fetch_stored_vectors(_get_readonly_conn(sqlite_path), [v for v in I[0] if v != -1])
+    return rescore(embedding[0], I[0], stored, k)
+
+def _load_chunk_text_jsonl(path: str, index: int) -> str:
     chunk_file = CHUNK_DIR / f"{path}.jsonl"
     if not chunk_file.exists():
         logging.warning(f"[WARN] チャンクファイルなし: {chunk_file}")
@@ -152,135 +898,538 @@ def load_chunk_text(path: str, index: int) -> str:
         logging.error(f"[ERROR] チャンク読込失敗: {chunk_file} → {e}")
     return ""
 
-@app.post("/embed_search")
-async def embed_search(req: EmbedRequest) -> Dict[str, Any]:
-    logging.info(f"[INFO] クエリ: {req.query} (top_k={req.top_k})")
+def _load_chunk_texts_jsonl(keys: List[Tuple[str, int]]) -> Dict[Tuple[str, int], str]:
+    return {(p, i): _load_chunk_text_jsonl(p, i) for p, i in keys}
 
-    embedding = np.array(model.encode([req.query], normalize_embeddings=True), dtype=np.float32)
-    if embedding.ndim == 1:
-        embedding = embedding.reshape(1, -1)
+def load_chunk_texts(keys: List[Tuple[str, int]]) -> Dict[Tuple[str, int], str]:
+    """(path, chunk_index) → 本文。チャンクストアから一括取得（未構築時のみJSONL走査）"""
+    if not keys:
+        return {}
+    if not CHUNK_STORE_PATH.exists():
+        return _load_chunk_texts_jsonl(keys)
+    try:
+        return fetch_texts(_get_readonly_conn(CHUNK_STORE_PATH), keys)
+    except Exception as e:
+        logging.error(f"[ERROR] チャンクストア読込失敗: {CHUNK_STORE_PATH} → {e}")
+        return _load_chunk_texts_jsonl(keys)
+
+def load_chunk_windows(centers: List[Tuple[str, int]], width: int) -> Dict[Tuple[str, int], Dict[int, str]]:
+    """(path, chunk_index) → {前後 width 件の chunk_index: 本文}。全件を1クエリで取得"""
+    if not centers or width <= 0:
+        return {}
+    if CHUNK_STORE_PATH.exists():
+        try:
+            return fetch_windows(_get_readonly_conn(CHUNK_STORE_PATH), centers, width)
+        except Exception as e:
+            logging.error(f"[ERROR] チャンクストア読込失敗: {CHUNK_STORE_PATH} → {e}")
+    texts = _load_chunk_texts_jsonl([(p, i + o) for p, i in centers for o in range(-width, width + 1)])
+    return {
+        (p, i): {i + o: texts[(p, i + o)] for o in range(-width, width + 1)}
+        for p, i in centers
+    }
+
+def _append_window(grouped_chunks: List[Dict[str, Any]], seen: set, target: Dict[str, Any], window: Dict[int, str], width: int) -> None:
+    """target の前後 width 件を chunk_index 順に追加（同じチャンクは1回だけ）"""
+    for idx in range(target["chunk_index"] - width, target["chunk_index"] + width + 1):
+        uid = f"{target['path']}:{idx}"
+        if uid in seen:
+            continue
+        seen.add(uid)
+        text = window.get(idx, target["text"] if idx == target["chunk_index"] else "")
+        if text.strip():
+            grouped_chunks.append({
+                "path": target["path"],
+                "chunk_index": idx,
+                "text": text,
+                "type": target["type"],
+                "score": target["adjusted_score"],
+            })
 
-    step1_hits: List[Dict[str, Any]] = []
+def load_chunk_text(path: str, index: int) -> str:
+    return load_chunk_texts([(path, index)]).get((path, index), "")
+
+# === クロスエンコーダー再ランキング（任意） ===
+# CROSS_ENCODER_PATH を指定すると、各グループの rerank_candidates 上位 CROSS_ENCODER_TOP_N 件を
+# 全グループ分まとめて (質問, 本文) の組で1バッチ採点し直す（1リクエストで使う枠は1つ）
+# 採点開始から CROSS_ENCODER_BUDGET_MS を超えたら従来の順位のまま返す
+# 他のリクエストの採点が STAGE_LIMIT_CROSS 件実行中なら、待たずに従来の順位で返す（時間切れの採点が積み上がらない）
+CROSS_ENCODER_PATH = os.getenv("CROSS_ENCODER_PATH", "")
+CROSS_ENCODER_TOP_N = int(os.getenv("CROSS_ENCODER_TOP_N", "20"))
+CROSS_ENCODER_BUDGET_MS = float(os.getenv("CROSS_ENCODER_BUDGET_MS", "300"))
+CROSS_ENCODER_INT8 = os.getenv("CROSS_ENCODER_INT8", "1") == "1"
+CROSS_ENCODER_MAX_LENGTH = int(os.getenv("CROSS_ENCODER_MAX_LENGTH", "512"))
+CROSS_ENCODER_SIGMOID = os.getenv("CROSS_ENCODER_SIGMOID", "1") == "1"  # ロジットを sigmoid で 0〜1 に（再ランキングのスコアと同じ尺度）
+CROSS_SCORE_CACHE = LRUCache(int(os.getenv("CROSS_SCORE_CACHE_SIZE", "8192")))
+CROSS_STATS = {"calls": 0, "scored": 0, "fallbacks": 0, "skipped": 0}
+
+def _load_cross_encoder():
+    if not CROSS_ENCODER_PATH:
+        return None
+    try:
+        from sentence_transformers import CrossEncoder
+        encoder = CrossEncoder(CROSS_ENCODER_PATH, device="cpu", max_length=CROSS_ENCODER_MAX_LENGTH)
+        if CROSS_ENCODER_INT8:
+            import torch
+            encoder.model = torch.quantization.quantize_dynamic(encoder.model, {torch.nn.Linear}, dtype=torch.qint8)
+        logging.info(f"[INFO] クロスエンコーダー読み込み完了: {CROSS_ENCODER_PATH}{'（int8）' if CROSS_ENCODER_INT8 else ''}")
+        return encoder
+    except Exception as e:
+        logging.error(f"[ERROR] クロスエンコーダー読み込み失敗（無効化）: {CROSS_ENCODER_PATH} → {e}")
+        return None
+
+cross_encoder = _load_cross_encoder()
+
+def cross_encode_scores(query: str, candidates: List[Dict[str, Any]]) -> List[float]:
+    """(質問, チャンク) のスコア（0〜1）。キャッシュにない分だけ1バッチで採点する（チャンクは uid + chunk_index で識別）"""
+    qkey = _normalize_query(query)
+    keys = [(qkey, c["uid"], c["chunk_index"]) for c in candidates]
+    scores = [CROSS_SCORE_CACHE.get(k) for k in keys]
+    missing = [i for i, sc in enumerate(scores) if sc is None]
+    if missing:
+        preds = cross_encoder.predict(
+            [(query, candidates[i]["text"]) for i in missing],
+            batch_size=len(missing), show_progress_bar=False,
+        )
+        preds = np.asarray(preds, dtype=np.float64).reshape(-1)
+        if CROSS_ENCODER_SIGMOID:
+            preds = 1 / (1 + np.exp(-preds))
+        for i, pred in zip(missing, preds):
+            scores[i] = float(pred)
+            CROSS_SCORE_CACHE.put(keys[i], scores[i])
+        CROSS_STATS["scored"] += len(missing)
+    return scores
+
+async def cross_rerank(query: str, groups: Dict[str, List[Dict[str, Any]]]) -> str:
+    """
+    全グループの上位候補を1バッチで採点し、グループごとにクロスエンコーダーの順へ並べ直す（その場で並べ替え）
+    戻り値: "scored" / "skipped"（他のリクエストが採点中）/ "fallback"（時間切れ・失敗）。後の2つは順位を変えない
+    """
+    if STAGE_SEMAPHORES["cross"].locked():
+        CROSS_STATS["skipped"] += 1
+        logging.info("[INFO] クロスエンコーダー実行中のため省略 → 従来順位")
+        return "skipped"
+    heads = [c for hits in groups.values() for c in hits]
+    CROSS_STATS["calls"] += 1
+    try:
+        scores = await run_stage_budget("cross", CROSS_ENCODER_BUDGET_MS / 1000, cross_encode_scores, query, heads)
+    except asyncio.TimeoutError:
+        CROSS_STATS["fallbacks"] += 1
+        logging.warning(f"[WARN] クロスエンコーダー時間切れ（{CROSS_ENCODER_BUDGET_MS}ms）→ 従来順位")
+        return "fallback"
+    except Exception as e:
+        CROSS_STATS["fallbacks"] += 1
+        logging.error(f"[ERROR] クロスエンコーダー失敗 → 従来順位: {e}")
+        return "fallback"
+    for c, sc in zip(heads, scores):
+        c["adjusted_score"] = round(sc, 4)
+    for hits in groups.values():
+        hits.sort(key=lambda x: -x["adjusted_score"])
+    return "scored"
+
+# === 文脈の組み立て（トークン上限つき） ===
+# MAX_CONTEXT_TOKENS（またはリクエストの max_context_tokens）> 0 なら、スコアの高いチャンクから
+# 上限に収まるだけ詰める。同じファイルの連続チャンクは1ブロックにまとめ、重なり（既定50文字）を除く
+MAX_CONTEXT_TOKENS = int(os.getenv("MAX_CONTEXT_TOKENS", "0"))
+TOKENIZER_PATH = os.getenv("TOKENIZER_PATH", "")  # 応答モデルのトークナイザー（未指定は概算）
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "50"))  # make_chunk_pdf.py / make_chunk_word.py と同じ値
+MIN_OVERLAP = 10  # これより短い一致は偶然とみなして除かない
+_ASCII_RUN = re.compile(r"[\x00-\x7f]+")
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+def _get_tokenizer():
+    global _tokenizer, TOKENIZER_PATH
+    if _tokenizer is None and TOKENIZER_PATH:
+        with _tokenizer_lock:
+            if _tokenizer is None and TOKENIZER_PATH:
+                try:
+                    from transformers import AutoTokenizer
+                    _tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH)
+                    logging.info(f"[INFO] トークナイザー読込: {TOKENIZER_PATH}")
+                except Exception as e:
+                    logging.warning(f"[WARN] トークナイザー読込失敗（概算で数える）: {TOKENIZER_PATH} → {e}")
+                    TOKENIZER_PATH = ""
+    return _tokenizer
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    tokenizer = _get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False))
+    # 概算: 英数字記号は4文字で1トークン、それ以外（かな漢字など）は1文字1トークン
+    ascii_chars = sum(len(m) for m in _ASCII_RUN.findall(text))
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+def _strip_overlap(prev: str, text: str) -> str:
+    """前のチャンクの末尾と重なる先頭部分を除く"""
+    for k in range(min(CHUNK_OVERLAP, len(prev), len(text)), MIN_OVERLAP - 1, -1):
+        if prev.endswith(text[:k]):
+            return text[k:]
+    return text
+
+def _file_blocks(chunks: Dict[int, Dict[str, Any]]) -> List[Tuple[float, str]]:
+    """1ファイル分の採用チャンク → 連続した chunk_index ごとのブロック（最高スコア, 本文）"""
+    blocks: List[Tuple[float, str]] = []
+    prev_idx, prev_text, score, parts = None, "", 0.0, []
+    for idx in sorted(chunks):
+        chunk = chunks[idx]
+        if prev_idx is not None and idx == prev_idx + 1:
+            parts.append(_strip_overlap(prev_text, chunk["text"]))
+            score = max(score, chunk["score"])
+        else:
+            if parts:
+                blocks.append((score, "".join(parts)))
+            parts, score = [chunk["text"]], chunk["score"]
+        prev_idx, prev_text = idx, chunk["text"]
+    if parts:
+        blocks.append((score, "".join(parts)))
+    return blocks
+
+def pack_context(grouped_chunks: List[Dict[str, Any]], max_tokens: int) -> str:
+    """スコア順に、トークン数の合計が max_tokens 以下に収まるチャンクを採用して文脈を組み立てる"""
+    selected: Dict[str, Dict[int, Dict[str, Any]]] = {}
+    labels: Dict[str, str] = {}
+    costs: Dict[str, int] = {}
+    total = 0
+
+    def file_cost(path: str, chunks: Dict[int, Dict[str, Any]]) -> int:
+        return sum(count_tokens(labels[path]) + count_tokens(text) for _, text in _file_blocks(chunks))
 
-    for db_group, sqlite_path in SQLITE_PATHS.items():
-        if not sqlite_path.exists() or not FAISS_INDEXES[db_group].exists():
-            logging.warning(f"[WARN] DB見つからず: {db_group}")
+    for chunk in sorted(grouped_chunks, key=lambda x: -x["score"]):
+        path = chunk["path"]
+        labels.setdefault(path, f"[FILE] {path}（{chunk['type']}）")
+        trial = {**selected.get(path, {}), chunk["chunk_index"]: chunk}
+        cost = file_cost(path, trial)
+        if total - costs.get(path, 0) + cost > max_tokens:
             continue
+        total += cost - costs.get(path, 0)
+        selected[path], costs[path] = trial, cost
+
+    blocks = [
+        (score, order, labels[path], text)
+        for order, (path, chunks) in enumerate(selected.items())
+        for score, text in _file_blocks(chunks)
+    ]
+    context_parts = []
+    for _, _, label, text in sorted(blocks, key=lambda x: (-x[0], x[1])):
+        context_parts.append(label)
+        context_parts.append(text)
+    logging.info(f"[INFO] 文脈トークン数: {total} / 上限 {max_tokens}（{len(blocks)} ブロック）")
+    return "\n\n".join(context_parts)
 
-        index = faiss.read_index(str(FAISS_INDEXES[db_group]))
-        k_search = max(req.top_k, 50)
-        D, I = index.search(embedding, k_search)
-
-        with sqlite3.connect(str(sqlite_path)) as conn:
-            cur = conn.cursor()
-            for score, vec_index in zip(D[0], I[0]):
-                if vec_index == -1:
-                    continue
-                # ★ fix: uid カラムを使用
-                cur.execute(
-                    "SELECT uid, chunk_index, path, type FROM vector_metadata WHERE vec_index=?",
-                    (int(vec_index),),
-                )
-                row = cur.fetchone()
-                if not row:
-                    continue
-                uid, chunk_index, path, dtype = row
-                text = load_chunk_text(path, int(chunk_index))
-                if not text.strip():
-                    continue
-                step1_hits.append({
-                    "vec_index": int(vec_index),
-                    "uid": uid,
-                    "chunk_index": int(chunk_index),
-                    "path": path,
-                    "type": dtype,
-                    "score": float(score),
-                    "source": db_group,
-                    "text": text,
-                })
-
-        logging.info(f"[INFO] ヒット件数: {len([h for h in step1_hits if h['source']==db_group])} 件 → {db_group}")
-
-    if not step1_hits:
-        return {"context_text": ""}
-
-    pdf_candidates = [h for h in step1_hits if h["source"] == "pdf_word"]
-    exlcal_candidates = [h for h in step1_hits if h["source"] == "excel_calendar"]
-
-    reranked_pdf = rerank_candidates(
-        req.query, pdf_candidates, given_keywords=req.keywords,
-        use_adjacency=True, final_topk=6, weights=(0.6, 0.3, 0.1)
-    )
-    reranked_exlcal = rerank_candidates(
-        req.query, exlcal_candidates, given_keywords=req.keywords,
-        use_adjacency=False, final_topk=15, weights=(0.7, 0.3, 0.0)
+async def search_group(
+    db_group: str, req: EmbedRequest, embedding: np.ndarray, lane_keywords: List[str],
+) -> List[Dict[str, Any]]:
+    """1グループ分の FAISS検索 → メタデータ → 本文 → キーワード融合 → 再ランキング（クロスエンコーダーを使うときは上位を多めに返す）"""
+    sqlite_path = SQLITE_PATHS[db_group]
+    conf = GROUPS[db_group]
+    trace = _EXPLAIN.get()
+    if trace is not None:
+        # このグループのタスク内の run_stage はグループ別の記録先に書く
+        trace = trace["groups"].setdefault(db_group, {"stages": []})
+        _EXPLAIN.set(trace)
+    k_search = max(req.top_k, 50)
+    types = tuple(t for t in conf["types"] if not req.types or t in req.types)
+    if not types:
+        return []
+
+    ids = None
+    if req.has_filters() and sqlite_path.exists():
+        ids = await run_stage(
+            "sqlite", resolve_filter_ids, db_group, sqlite_path, types,
+            req.path_prefix, req.mtime_from, req.mtime_to,
+        )
+        logging.info(f"[INFO] 絞り込み: {len(ids)} 件 → {db_group}")
+        if len(ids) == 0:
+            return []
+
+    # 絞り込み条件がなければ、文書単位で上位 doc_top_k 文書を選んでからそのチャンクだけを検索する
+    search_ids, k_chunks = ids, k_search
+    if ids is None and DOC_TOP_K[db_group] > 0 and sqlite_path.exists():
+        doc_chunk_ids = await run_stage(
+            "search", resolve_doc_ids, db_group, sqlite_path, embedding, DOC_TOP_K[db_group]
+        )
+        if doc_chunk_ids is not None and len(doc_chunk_ids):
+            # 1文書あたりの件数を抑えて間引くぶん多めに取る
+            search_ids, k_chunks = doc_chunk_ids, k_search * 2
+
+    result = await run_stage(
+        "search", _faiss_search, db_group, embedding, k_chunks,
+        nprobe=req.nprobe, ef_search=req.ef_search, ids=search_ids,
     )
+    if not sqlite_path.exists() or result is None:
+        logging.warning(f"[WARN] DB見つからず: {db_group}")
+        return []
+    D, I, rescore_factor, exact = result
+    if trace is not None:
+        trace["search"] = {
+            "k": k_chunks,
+            "filter_ids": None if ids is None else len(ids),
+            "doc_chunk_ids": len(search_ids) if search_ids is not None and ids is None else None,
+            "exact": exact,
+            "rescore_factor": rescore_factor,
+        }
+    if rescore_factor:
+        D, I = await run_stage("sqlite", _rescore_hits, sqlite_path, embedding, I, k_chunks)
+
+    metas = await run_stage("sqlite", fetch_metadata, sqlite_path, [int(v) for v in I[0] if v != -1])
+    rows = []
+    for score, vec_index in zip(D[0], I[0]):
+        row = metas.get(int(vec_index))
+        if row is None:
+            continue
+        rows.append((float(score), int(vec_index), row))
+    if k_chunks > k_search:
+        rows = _cap_per_doc(rows, DOC_MAX_CHUNKS)[:k_search]
+
+    texts = await run_stage("text", load_chunk_texts, [(row[2], int(row[1])) for _, _, row in rows])
+    dense_hits: List[Dict[str, Any]] = []
+    for score, vec_index, (uid, chunk_index, path, dtype) in rows:
+        text = texts.get((path, int(chunk_index)), "")
+        if not text.strip():
+            continue
+        dense_hits.append({
+            "vec_index": vec_index,
+            "uid": uid,
+            "chunk_index": int(chunk_index),
+            "path": path,
+            "type": dtype,
+            "score": score,
+            "source": db_group,
+            "text": text,
+        })
 
-    logging.info(f"[INFO] filtered(pdf_word Top6): {len(reranked_pdf)} / filtered(excel_calendar Top15): {len(reranked_exlcal)}")
+    kw_hits = []
+    if lane_keywords:
+        kw_hits = await run_stage(
+            "keyword", keyword_hits, db_group, sqlite_path, lane_keywords, embedding, BM25_TOP_K,
+            types=types, path_prefix=req.path_prefix, allowed_ids=ids,
+        )
+    candidates = fuse_hits(dense_hits, kw_hits, k_search)
+    logging.info(f"[INFO] ヒット件数: {len(candidates)} 件 → {db_group}（キーワード {len(kw_hits)} 件を融合）")
+    if not candidates:
+        return []
 
+    rerank_args = dict(conf["rerank"])
+    use_cross = cross_encoder is not None and req.cross_encoder
+    if use_cross:
+        # クロスエンコーダーに渡す候補を多めに残す
+        rerank_args["final_topk"] = max(rerank_args["final_topk"], CROSS_ENCODER_TOP_N)
+    reranked = await run_stage(
+        "rerank", rerank_candidates, req.query, candidates, given_keywords=req.keywords,
+        explain=trace, **rerank_args
+    )
+    reranked.sort(key=lambda x: -x["adjusted_score"])
+    return reranked
+
+async def load_group_windows(db_group: str, reranked: List[Dict[str, Any]]) -> Dict[Tuple[str, int], Dict[int, str]]:
+    """最終順位の上位 expand_top 件の前後文脈（失敗時は前後文脈なし）"""
+    width = CONTEXT_WINDOWS[db_group]
+    if width <= 0 or not reranked:
+        return {}
+    trace = _EXPLAIN.get()
+    if trace is not None:
+        _EXPLAIN.set(trace["groups"].setdefault(db_group, {"stages": []}))
+    try:
+        return await run_stage(
+            "text", load_chunk_windows,
+            [(h["path"], h["chunk_index"]) for h in reranked[:GROUPS[db_group]["expand_top"]]], width,
+        )
+    except Exception as e:
+        logging.error(f"[ERROR] 前後文脈の取得失敗: {db_group} → {e}")
+        return {}
+
+def _explain_final(trace: Dict[str, Any], reranked: List[Dict[str, Any]], expand_top: int, cross_status: Optional[str]) -> None:
+    """最終順位（クロスエンコーダー後）と前後文脈を付けるかを候補の内訳に書き足す"""
+    final = {(h["path"], h["chunk_index"]): r for r, h in enumerate(reranked)}
+    for row in trace.get("candidates", []):
+        rank = None if row["duplicate"] else final.get((row["path"], row["chunk_index"]))
+        row["final_rank"] = rank
+        row["final_score"] = reranked[rank]["adjusted_score"] if rank is not None else None
+        row["expanded"] = rank is not None and rank < expand_top
+    trace["cross_encoder"] = cross_status
+
+async def _search_group_with_timeout(db_group: str, *args):
+    """
+    タイムアウト・例外のグループは None（他のグループの結果だけで応答する）
+    打ち切ったグループの次の段階は始まらず、実行中の段階は終わるまで段階の枠を使い続ける
+    """
+    trace = _EXPLAIN.get()
+    started = time.perf_counter()
+    result, status = None, "error"
+    try:
+        result = await asyncio.wait_for(search_group(db_group, *args), GROUP_TIMEOUT_SEC)
+        status = "hit" if result else "empty"
+    except asyncio.TimeoutError:
+        status = "timeout"
+        logging.warning(f"[WARN] グループ検索タイムアウト（{GROUP_TIMEOUT_SEC}秒）: {db_group}")
+    except Exception as e:
+        logging.error(f"[ERROR] グループ検索失敗: {db_group} → {e}")
+    elapsed = time.perf_counter() - started
+    if trace is not None:
+        trace["groups"].setdefault(db_group, {"stages": []}).update(status=status, ms=round(elapsed * 1000, 2))
+    if METRICS:
+        GROUP_SECONDS.labels(db_group).observe(elapsed)
+        GROUP_RESULTS.labels(db_group, status).inc()
+        if result is not None:
+            GROUP_HITS.labels(db_group).inc(min(len(result), GROUPS[db_group]["rerank"]["final_topk"]))
+    return result
+
+@app.post("/embed_search")
+async def embed_search(req: EmbedRequest) -> Dict[str, Any]:
+    logging.info(f"[INFO] クエリ: {req.query} (top_k={req.top_k})")
+    started = time.perf_counter()
+    check_indexes()
+
+    cache_key = (
+        _normalize_query(req.query), tuple(req.keywords), req.top_k, req.hybrid,
+        req.nprobe, req.ef_search, tuple(req.types), req.path_prefix, req.mtime_from, req.mtime_to,
+        req.max_context_tokens, req.cross_encoder and cross_encoder is not None,
+        index_generations(),
+    )
+    # explain は毎回計測するためキャッシュを読み書きしない
+    cached = RESULT_CACHE.get(cache_key) if not req.explain else None
+    if cached is not None:
+        logging.info("[INFO] 検索結果キャッシュ使用")
+        if METRICS:
+            REQUESTS.labels("cached").inc()
+            REQUEST_SECONDS.observe(time.perf_counter() - started)
+        return cached
+
+    trace = None
+    if req.explain:
+        trace = {"stages": [], "groups": {}}
+        trace_token = _EXPLAIN.set(trace)
+    # 埋め込みはバックエンドごとに1回（同じバックエンドのグループは同じベクトルを使う）
+    vectors = await asyncio.gather(*(encode_query(req.query, e) for e in EMBEDDERS.values()))
+    embeddings = dict(zip(EMBEDDERS, vectors))
+    encode_ms = (time.perf_counter() - started) * 1000
+    lane_keywords = (req.keywords or lane_keywords_from_query(req.query)) if KEYWORD_SEARCH and req.hybrid else []
+
+    # 全グループを並列に検索し、結果をグループ順にまとめる
+    results = await asyncio.gather(*(
+        _search_group_with_timeout(db_group, req, embeddings[GROUP_EMBEDDERS[db_group].name], lane_keywords)
+        for db_group in GROUPS
+    ))
+
+    # クロスエンコーダーは全グループの上位候補をまとめて1回だけ採点する
+    hits = {db_group: result for db_group, result in zip(GROUPS, results) if result}
+    cross_status = None
+    if cross_encoder is not None and req.cross_encoder and hits:
+        cross_status = await cross_rerank(req.query, hits)
+    final = {}
+    for db_group, result in zip(GROUPS, results):
+        final_topk = GROUPS[db_group]["rerank"]["final_topk"]
+        final[db_group] = (result or [])[:final_topk]
+        logging.info(f"[INFO] filtered({db_group} Top{final_topk}): {len(final[db_group])}")
+        if trace is not None and result is not None:
+            _explain_final(trace["groups"][db_group], final[db_group], GROUPS[db_group]["expand_top"], cross_status)
+    group_windows = await asyncio.gather(*(load_group_windows(db_group, final[db_group]) for db_group in GROUPS))
+
+    assembly_started = time.perf_counter()
     grouped_chunks: List[Dict[str, Any]] = []
     seen = set()
 
-    # PDF/Word: Top3に前後±1付与 → 次の3件はそのまま
-    word_hits_sorted = sorted(reranked_pdf, key=lambda x: -x["adjusted_score"])
-    top3 = word_hits_sorted[:3]
-    next3 = word_hits_sorted[3:6]
-
-    for target in top3:
-        for offset in (-1, 0, 1):
-            idx = target["chunk_index"] + offset
-            uid = f"{target['path']}:{idx}"
-            if uid in seen:
-                continue
-            seen.add(uid)
-            text = load_chunk_text(target["path"], idx)
-            if text.strip():
-                grouped_chunks.append({
-                    "path": target["path"],
-                    "chunk_index": idx,
-                    "text": text,
-                    "type": target["type"],
-                    "score": target["adjusted_score"],
-                })
-
-    for h in next3:
-        uid = f"{h['path']}:{h['chunk_index']}"
-        if uid in seen:
-            continue
-        seen.add(uid)
-        grouped_chunks.append({
-            "path": h["path"],
-            "chunk_index": h["chunk_index"],
-            "text": h["text"],
-            "type": h["type"],
-            "score": h["adjusted_score"],
-        })
-
-    # Excel/Calendar: Top15 をスコア高い順で
-    for h in sorted(reranked_exlcal, key=lambda x: -x["adjusted_score"]):
-        uid = f"{h['path']}:{h['chunk_index']}"
-        if uid in seen:
-            continue
-        seen.add(uid)
-        grouped_chunks.append({
-            "path": h["path"],
-            "chunk_index": h["chunk_index"],
-            "text": h["text"],
-            "type": h["type"],
-            "score": h["adjusted_score"],
-        })
+    # 各グループ: 上位 expand_top 件に前後の文脈を付与 → 残りはそのまま
+    # （pdf_word: Top3 に前後±1 + 次の3件 / excel_calendar: Top15）
+    # クロスエンコーダーを省略・打ち切った応答は順位が劣るのでキャッシュしない
+    complete = all(r is not None for r in results) and cross_status in (None, "scored")
+    for db_group, windows in zip(GROUPS, group_windows):
+        reranked = final[db_group]
+        expand_top = GROUPS[db_group]["expand_top"]
+        width = CONTEXT_WINDOWS[db_group]
+        for h in reranked[:expand_top]:
+            _append_window(grouped_chunks, seen, h, windows.get((h["path"], h["chunk_index"]), {}), width)
+        for h in reranked[expand_top:]:
+            _append_window(grouped_chunks, seen, h, {}, 0)
 
     logging.info(f"[INFO] grouped_chunks: {len(grouped_chunks)} 件")
 
-    context_parts = []
-    for chunk in sorted(grouped_chunks, key=lambda x: -x["score"]):
-        label = f"[FILE] {chunk['path']}（{chunk['type']}）"
-        context_parts.append(label)
-        context_parts.append(chunk["text"])
-    context_text = "\n\n".join(context_parts)
+    max_tokens = req.max_context_tokens if req.max_context_tokens is not None else MAX_CONTEXT_TOKENS
+    if max_tokens > 0:
+        context_text = pack_context(grouped_chunks, max_tokens)
+    else:
+        context_parts = []
+        for chunk in sorted(grouped_chunks, key=lambda x: -x["score"]):
+            label = f"[FILE] {chunk['path']}（{chunk['type']}）"
+            context_parts.append(label)
+            context_parts.append(chunk["text"])
+        context_text = "\n\n".join(context_parts)
     logging.info(f"[INFO] context_text 文字数: {len(context_text)} 文字")
 
-    return {"context_text": context_text}
+    response = {"context_text": context_text}
+    if trace is not None:
+        _EXPLAIN.reset(trace_token)
+        response["explain"] = {
+            "timings_ms": {
+                "encode": round(encode_ms, 2),
+                "assembly": round((time.perf_counter() - assembly_started) * 1000, 2),
+                "total": round((time.perf_counter() - started) * 1000, 2),
+            },
+            "keywords": lane_keywords,
+            "cross_encoder": cross_status,
+            "stages": trace["stages"],
+            "params": {
+                db_group: {
+                    **GROUPS[db_group]["rerank"],
+                    "expand_top": GROUPS[db_group]["expand_top"],
+                    "context_window": CONTEXT_WINDOWS[db_group],
+                    "doc_top_k": DOC_TOP_K[db_group],
+                }
+                for db_group in GROUPS
+            },
+            "groups": trace["groups"],
+        }
+    elif complete:
+        # タイムアウト等で欠けた結果はキャッシュしない
+        RESULT_CACHE.put(cache_key, response)
+    if METRICS:
+        finished = time.perf_counter()
+        ASSEMBLY_SECONDS.observe(finished - assembly_started)
+        REQUEST_SECONDS.observe(finished - started)
+        REQUESTS.labels("hit" if grouped_chunks else "empty").inc()
+    return response
+
+@app.get("/stats")
+async def stats():
+    return {
+        "embed_cache": EMBED_CACHE.stats(),
+        "embed_batch": {name: batcher.stats() for name, batcher in EMBED_BATCHERS.items()},
+        "embedding_backends": {group: e.name for group, e in GROUP_EMBEDDERS.items()},
+        "result_cache": RESULT_CACHE.stats(),
+        "cross_encoder": {**CROSS_STATS, "enabled": cross_encoder is not None, "score_cache": CROSS_SCORE_CACHE.stats()},
+        "index_generations": dict(zip(GROUPS, index_generations())),
+    }
+
+class ServiceCollector:
+    """スクレイプ時にだけ読む値（インデックス件数・世代、キャッシュ）"""
+
+    def collect(self):
+        vectors = GaugeMetricFamily("vector_index_vectors", "インデックスのベクトル件数（kind: chunk / doc）", labels=["group", "kind"])
+        generation = GaugeMetricFamily("vector_index_generation", "読み込み中のインデックス世代（未読込は -1）", labels=["group"])
+        for group in GROUPS:
+            entry = INDEX_CACHE.peek(group)
+            generation.add_metric([group], entry["generation"] if entry is not None else -1)
+            for kind, cache in (("chunk", INDEX_CACHE), ("doc", DOC_INDEX_CACHE)):
+                entry = cache.peek(group)
+                if entry is not None:
+                    vectors.add_metric([group, kind], entry["index"].ntotal)
+        entries = GaugeMetricFamily("vector_cache_entries", "キャッシュの件数", labels=["cache"])
+        hit_ratio = GaugeMetricFamily("vector_cache_hit_ratio", "キャッシュのヒット率（起動からの累計）", labels=["cache"])
+        for name, cache in (("embed", EMBED_CACHE), ("result", RESULT_CACHE), ("cross_score", CROSS_SCORE_CACHE)):
+            st = cache.stats()
+            entries.add_metric([name], st["size"])
+            hit_ratio.add_metric([name], st["hit_ratio"])
+        yield from (vectors, generation, entries, hit_ratio)
+
+if METRICS:
+    prom.REGISTRY.register(ServiceCollector())
+
+@app.get("/metrics")
+async def metrics():
+    if not METRICS:
+        return Response("prometheus_client が未インストールです\n", status_code=503, media_type="text/plain")
+    return Response(prom.generate_latest(), media_type=prom.CONTENT_TYPE_LATEST)
 
 @app.get("/")
 async def root():
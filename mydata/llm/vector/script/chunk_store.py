@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+chunk_store.py
+チャンク本文の索引付きストア（SQLite）
+(path, chunk_index) で直接引けるようにし、検索時のJSONL全行走査をなくす
+書き込み：make_chunk_*.py / generate_chunk.py / delete_chunk.py
+読み込み：main.py（検索API）
+キーワード用の転置インデックス（keyword_index.py）も同じDB内で一緒に更新する
+"""
+
+import json
+import sqlite3
+from pathlib import Path
+from typing import List, Dict, Any, Iterable, Tuple
+
+import keyword_index
+
+ROOT = Path("/mydata/llm/vector")
+CHUNK_DIR = ROOT / "db/chunk"
+STORE_PATH = ROOT / "db/chunk_store.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    chunk_index INTEGER NOT NULL,
+    uid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    text TEXT NOT NULL,
+    UNIQUE(path, chunk_index)
+);
+CREATE TABLE IF NOT EXISTS chunk_files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL
+);
+"""
+
+# ====== 1. 接続 ======
+def connect(store_path: Path = STORE_PATH) -> sqlite3.Connection:
+    """書き込み用接続（複数プロセスから同時に書くため WAL + 長めの待ち時間）"""
+    store_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(store_path), timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    if not keyword_index.has_schema(conn):
+        # 転置インデックス導入前のストア → 既存チャンクを一括投入
+        # チャンカーの複数プロセスが同時に来ても1回だけ投入するよう、確認〜投入を書き込みロック内で行う
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if keyword_index.ensure_schema(conn):
+                keyword_index.index_chunks(conn, conn.execute("SELECT id, text FROM chunks").fetchall())
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return conn
+
+# ====== 2. 書き込み ======
+def replace_file(conn: sqlite3.Connection, rel_path: str, records: List[Dict[str, Any]], mtime_ns: int) -> None:
+    """1ファイル分のチャンクを丸ごと入れ替える（呼び出し側でトランザクション管理）"""
+    _delete_chunks(conn, rel_path)
+    by_index = {int(r["index"]): r for r in records}
+    conn.executemany(
+        "INSERT INTO chunks (path, chunk_index, uid, type, text) VALUES (?, ?, ?, ?, ?)",
+        [
+            (rel_path, idx, r["uid"], r.get("type", "unknown"), r.get("text", ""))
+            for idx, r in by_index.items()
+        ],
+    )
+    keyword_index.index_chunks(
+        conn, conn.execute("SELECT id, text FROM chunks WHERE path=?", (rel_path,)).fetchall()
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO chunk_files (path, mtime_ns) VALUES (?, ?)",
+        (rel_path, mtime_ns),
+    )
+
+def _delete_chunks(conn: sqlite3.Connection, rel_path: str) -> None:
+    keyword_index.unindex_chunks(
+        conn, conn.execute("SELECT id, text FROM chunks WHERE path=?", (rel_path,)).fetchall()
+    )
+    conn.execute("DELETE FROM chunks WHERE path=?", (rel_path,))
+
+def remove_file(conn: sqlite3.Connection, rel_path: str) -> None:
+    _delete_chunks(conn, rel_path)
+    conn.execute("DELETE FROM chunk_files WHERE path=?", (rel_path,))
+
+def write_chunk_file(rel_path: str, records: List[Dict[str, Any]], jsonl_path: Path) -> None:
+    """チャンカーがJSONLを書いた直後に呼ぶ"""
+    conn = connect()
+    try:
+        with conn:
+            replace_file(conn, rel_path, records, jsonl_path.stat().st_mtime_ns)
+    finally:
+        conn.close()
+
+def _read_jsonl_records(chunk_file: Path) -> List[Dict[str, Any]]:
+    records = []
+    with chunk_file.open("r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    return records
+
+def sync_from_jsonl(chunk_dir: Path = CHUNK_DIR) -> Tuple[int, int]:
+    """
+    JSONL（正本）とストアを突き合わせる
+    ・ストア未登録／更新されたファイル → 取り込み
+    ・消えたファイル → ストアから削除
+    戻り値: (取り込み件数, 削除件数)
+    """
+    conn = connect()
+    try:
+        known = dict(conn.execute("SELECT path, mtime_ns FROM chunk_files").fetchall())
+        on_disk = set()
+        loaded = 0
+        for chunk_file in chunk_dir.rglob("*.jsonl"):
+            rel_path = str(chunk_file.relative_to(chunk_dir))[:-len(".jsonl")]
+            on_disk.add(rel_path)
+            mtime_ns = chunk_file.stat().st_mtime_ns
+            if known.get(rel_path) == mtime_ns:
+                continue
+            try:
+                records = _read_jsonl_records(chunk_file)
+            except Exception as e:
+                print(f"[WARN] チャンクストア取込失敗: {chunk_file} ({e})")
+                continue
+            with conn:
+                replace_file(conn, rel_path, records, mtime_ns)
+            loaded += 1
+
+        removed = 0
+        for rel_path in set(known) - on_disk:
+            with conn:
+                remove_file(conn, rel_path)
+            removed += 1
+    finally:
+        conn.close()
+
+    print(f"[INFO] チャンクストア同期: 取込 {loaded} ファイル / 削除 {removed} ファイル")
+    return loaded, removed
+
+# ====== 3. 読み込み ======
+def fetch_texts(conn: sqlite3.Connection, keys: Iterable[Tuple[str, int]]) -> Dict[Tuple[str, int], str]:
+    """(path, chunk_index) のリストを1クエリでまとめて引く"""
+    pairs = [[p, int(i)] for p, i in keys]
+    if not pairs:
+        return {}
+    rows = conn.execute(
+        """
+        SELECT c.path, c.chunk_index, c.text
+        FROM json_each(?) AS k
+        JOIN chunks AS c
+          ON c.path = json_extract(k.value, '$[0]')
+         AND c.chunk_index = json_extract(k.value, '$[1]')
+        """,
+        (json.dumps(pairs, ensure_ascii=False),),
+    ).fetchall()
+    return {(p, int(i)): t for p, i, t in rows}
+
+def fetch_windows(conn: sqlite3.Connection, centers: Iterable[Tuple[str, int]], width: int) -> Dict[Tuple[str, int], Dict[int, str]]:
+    """
+    (path, chunk_index) ごとに前後 width 件の連続チャンクを1クエリでまとめて引く
+    戻り値: (path, 中心の chunk_index) → {chunk_index: 本文}
+    """
+    pairs = [[p, int(i)] for p, i in dict.fromkeys((p, int(i)) for p, i in centers)]
+    if not pairs:
+        return {}
+    rows = conn.execute(
+        """
+        SELECT json_extract(k.value, '$[0]'), json_extract(k.value, '$[1]'), c.chunk_index, c.text
+        FROM json_each(?) AS k
+        JOIN chunks AS c
+          ON c.path = json_extract(k.value, '$[0]')
+         AND c.chunk_index BETWEEN json_extract(k.value, '$[1]') - ? AND json_extract(k.value, '$[1]') + ?
+        """,
+        (json.dumps(pairs, ensure_ascii=False), int(width), int(width)),
+    ).fetchall()
+    windows: Dict[Tuple[str, int], Dict[int, str]] = {(p, i): {} for p, i in pairs}
+    for p, center, idx, text in rows:
+        windows[(p, int(center))][int(idx)] = text
+    return windows
@@ -1,67 +1,309 @@
-from chromadb import PersistentClient
-from sentence_transformers import SentenceTransformer
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+debugvs.py
+検索API（main.py）と同じ検索処理を、稼働中の FAISS + SQLite に対して直接実行する確認・ベンチマーク用CLI
+インデックスやモデルを変えた後に、ヒットの変化と段階ごとの時間を確かめる
+
+使用方法:
+  python3 debugvs.py "公職選挙法の一票の格差"                       # 1件検索してヒットと段階ごとの時間を表示
+  python3 debugvs.py --query-file queries.txt --concurrency 1 4 8   # p50/p95/p99・スループット・段階別時間
+  python3 debugvs.py --query-file queries.txt --save after.json --baseline before.json   # 前回とのヒット一致率
+ベンチマーク: レイテンシ・スループットは通常のリクエスト（explain なし）で測り、段階別の平均はメトリクス
+（vector_stage_seconds 等。prometheus_client が必要）の増分から出す。そのあと explain=true で各クエリを
+1回ずつ順に投げ、段階別の p50/p95/p99 とヒットを取る（explain はキャッシュを使わず候補の内訳も作るため別計測）
+既定では埋め込み・検索結果キャッシュを無効にして毎回エンコードから測る（--cache で有効）
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
 from pathlib import Path
+from collections import defaultdict
+from typing import List, Dict, Any, Tuple
 
-# === 設定 ===
-MODEL_PATH = "/mydata/llm/vector/models/legal-bge-m3"
-VECTOR_CONFIGS = [
-    {
-        "name": "vector_pdf_word",
-        "path": "/mydata/llm/vector/db/chroma/pdf_word"
-    },
-    {
-        "name": "vector_excel_calendar",
-        "path": "/mydata/llm/vector/db/chroma/excel_calendar"
-    }
-]
+import numpy as np
 
-def search_vector(query: str, top_k: int = 20):
-    model = SentenceTransformer(MODEL_PATH)
-    embedding = model.encode([query], convert_to_numpy=True, normalize_embeddings=True).tolist()
+CACHE_ENV = ("EMBED_CACHE_SIZE", "RESULT_CACHE_SIZE", "CROSS_SCORE_CACHE_SIZE", "FILTER_CACHE_SIZE")
 
-    for cfg in VECTOR_CONFIGS:
-        print(f"\n=== ▶ コレクション検索: {cfg['name']} ===")
-        try:
-            client = PersistentClient(path=cfg["path"])
-            collection = client.get_collection(name=cfg["name"])
+def load_service(use_cache: bool):
+    """main.py を読み込む（埋め込みモデル・インデックスの読み込みを含む）"""
+    if not use_cache:
+        for name in CACHE_ENV:
+            os.environ[name] = "0"
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import main
+    return main
+
+def load_queries(args) -> List[str]:
+    if args.query_file:
+        with open(args.query_file, encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    return [args.query]
+
+def make_request(service, query: str, args, explain: bool = False):
+    return service.EmbedRequest(
+        query=query, top_k=args.top_k, hybrid=not args.no_hybrid, nprobe=args.nprobe,
+        ef_search=args.ef_search, cross_encoder=not args.no_cross, explain=explain,
+    )
+
+# ====== 1. 1リクエスト分の集計 ======
+def final_hits(explain: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    """グループごとの最終順位のヒット（explain の候補内訳から）"""
+    hits = {}
+    for group, g in explain["groups"].items():
+        rows = [r for r in g.get("candidates", []) if r.get("final_rank") is not None]
+        hits[group] = sorted(rows, key=lambda r: r["final_rank"])
+    return hits
+
+def stage_times(explain: Dict[str, Any]) -> Dict[str, float]:
+    """段階名 → ms（同じ段階を複数回呼んだ場合は合計）"""
+    times: Dict[str, float] = defaultdict(float)
+    times["encode"] = explain["timings_ms"]["encode"]
+    for group, g in explain["groups"].items():
+        times[f"{group} 全体"] = g.get("ms", 0.0)
+        for st in g.get("stages", []):
+            times[f"{group} {st['stage']}/{st['step']}"] += st["ms"]
+    # クロスエンコーダーなどリクエスト全体で1回の段階
+    for st in explain.get("stages", []):
+        times[f"{st['stage']}/{st['step']}"] += st["ms"]
+    times["assembly"] = explain["timings_ms"]["assembly"]
+    return times
 
-            results = collection.query(
-                query_embeddings=embedding,
-                n_results=top_k,
-                include=["distances", "metadatas", "documents"]
+def percentiles(values: List[float]) -> Tuple[float, float, float]:
+    if not values:
+        return 0.0, 0.0, 0.0
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return float(p50), float(p95), float(p99)
+
+# ====== 2. 1件検索 ======
+async def run_single(service, query: str, args) -> None:
+    started = time.perf_counter()
+    response = await service.embed_search(make_request(service, query, args, explain=True))
+    elapsed = (time.perf_counter() - started) * 1000
+    explain = response["explain"]
+    hits = final_hits(explain)
+
+    keys = [(r["path"], r["chunk_index"]) for rows in hits.values() for r in rows]
+    texts = service.load_chunk_texts(keys)
+    for group, rows in hits.items():
+        g = explain["groups"][group]
+        print(f"\n=== ▶ {group}（{g.get('status')} / {g.get('ms', 0):.1f}ms / 候補 {len(g.get('candidates', []))} 件） ===")
+        for r in rows:
+            preview = texts.get((r["path"], r["chunk_index"]), "")[:80].replace("\n", "")
+            print(
+                f"#{r['final_rank']:<2} [{r['final_score']:.4f}] faiss={r['faiss_score']:.4f} kw={r['keyword_score']:.2f} "
+                f"| {r['path']} #{r['chunk_index']} | {preview}"
             )
+        if not rows:
+            print("ヒットなし")
+
+    print(f"\n[INFO] 段階別時間（explain 込みの合計 {elapsed:.1f}ms）")
+    for name, ms in stage_times(explain).items():
+        print(f"  {name:<45}{ms:>9.2f} ms")
+
+# ====== 3. ベンチマーク ======
+def metric_totals(service) -> Dict[str, Tuple[float, float]]:
+    """処理時間のヒストグラム → 段階名: (合計秒, 件数)。prometheus_client がなければ空"""
+    if not service.METRICS:
+        return {}
+    sources = (
+        (service.STAGE_SECONDS, lambda labels: f"{labels['stage']}/{labels['step']}"),
+        (service.GROUP_SECONDS, lambda labels: f"{labels['group']} 全体"),
+        (service.ASSEMBLY_SECONDS, lambda labels: "assembly"),
+    )
+    totals: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0.0])
+    for histogram, name_of in sources:
+        for metric in histogram.collect():
+            for sample in metric.samples:
+                if sample.name.endswith("_sum"):
+                    totals[name_of(sample.labels)][0] = sample.value
+                elif sample.name.endswith("_count"):
+                    totals[name_of(sample.labels)][1] = sample.value
+    return {name: (v[0], v[1]) for name, v in totals.items()}
+
+def mean_deltas(before: Dict[str, Tuple[float, float]], after: Dict[str, Tuple[float, float]]) -> Dict[str, float]:
+    """2時点の (合計秒, 件数) の差 → 段階名: 1回あたり平均 ms"""
+    means = {}
+    for name, (total, count) in after.items():
+        prev_total, prev_count = before.get(name, (0.0, 0.0))
+        if count > prev_count:
+            means[name] = (total - prev_total) * 1000 / (count - prev_count)
+    return means
+
+async def run_level(service, queries: List[str], args, concurrency: int) -> Dict[str, Any]:
+    """concurrency 個のクライアントが queries × repeat を分け合って順に投げる（explain なし）"""
+    queue: asyncio.Queue = asyncio.Queue()
+    for _ in range(args.repeat):
+        for q in queries:
+            queue.put_nowait(q)
+    latencies: List[float] = []
+    errors = 0
+
+    async def client():
+        nonlocal errors
+        while True:
+            try:
+                q = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            started = time.perf_counter()
+            try:
+                await service.embed_search(make_request(service, q, args))
+            except Exception as e:
+                errors += 1
+                print(f"[ERROR] {q} → {e}")
+                continue
+            latencies.append((time.perf_counter() - started) * 1000)
 
-            hits = []
-            for i in range(len(results["ids"][0])):
-                # --- コサイン類似度に変換（距離:0=完全一致,1=無関係 → 類似度:1=完全一致,0=無関係）
-                distance = results["distances"][0][i]
-                score = 1 - distance
-
-                meta = results["metadatas"][0][i]
-                text = results["documents"][0][i]
-                hits.append({
-                    "score": score,
-                    "uid": meta.get("uid"),
-                    "path": meta.get("path"),
-                    "chunk_index": meta.get("chunk_index"),
-                    "preview": text[:100].replace("\n", "")
-                })
-
-            # スコア順に並べ替え（高いほど類似）
-            hits.sort(key=lambda x: x["score"], reverse=True)
-            for h in hits:
-                print(f"[{h['score']:.4f}] {h['uid']} | {h['path']} | #{h['chunk_index']} | {h['preview']}")
-
-            if not hits:
-                print("ヒットなし")
+    before = metric_totals(service)
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / wall if wall > 0 else 0.0,
+        "latency_ms": dict(zip(("p50", "p95", "p99"), percentiles(latencies)), mean=float(np.mean(latencies)) if latencies else 0.0),
+        "stage_mean_ms": mean_deltas(before, metric_totals(service)),
+    }
+
+async def run_explain(service, queries: List[str], args) -> Dict[str, Any]:
+    """explain=true で各クエリを1回ずつ順に投げ、段階別の時間とヒットを集める"""
+    stages: Dict[str, List[float]] = defaultdict(list)
+    hits: Dict[str, Dict[str, List[List[Any]]]] = {}
+    for q in queries:
+        try:
+            response = await service.embed_search(make_request(service, q, args, explain=True))
         except Exception as e:
-            print(f"[ERROR] {cfg['name']} → {e}")
+            print(f"[ERROR] {q} → {e}")
+            continue
+        for name, ms in stage_times(response["explain"]).items():
+            stages[name].append(ms)
+        hits[q] = {
+            group: [[r["path"], r["chunk_index"]] for r in rows]
+            for group, rows in final_hits(response["explain"]).items()
+        }
+    return {
+        "stages_ms": {name: dict(zip(("p50", "p95", "p99"), percentiles(v))) for name, v in stages.items()},
+        "hits": hits,
+    }
 
-if __name__ == "__main__":
-    import sys
-    if len(sys.argv) < 2:
-        print("使用方法: python3 debugvs.py '検索語句'")
-    else:
-        query = sys.argv[1]
-        search_vector(query)
+def print_level(result: Dict[str, Any]) -> None:
+    lat = result["latency_ms"]
+    print(f"\n== 同時 {result['concurrency']} クライアント（{result['requests']} 件 / エラー {result['errors']} 件） ==")
+    print(f"  レイテンシ: p50 {lat['p50']:.1f}ms / p95 {lat['p95']:.1f}ms / p99 {lat['p99']:.1f}ms / 平均 {lat['mean']:.1f}ms")
+    print(f"  スループット: {result['throughput']:.2f} 件/秒")
+    if not result["stage_mean_ms"]:
+        print("  [WARN] prometheus_client がないため段階別の平均は出せません")
+        return
+    print(f"  {'段階':<40}{'平均ms':>9}")
+    for name, ms in sorted(result["stage_mean_ms"].items()):
+        print(f"  {name:<40}{ms:>9.2f}")
+
+def print_explain(result: Dict[str, Any]) -> None:
+    print(f"\n== explain（同時 1 / 各クエリ1回） ==")
+    print(f"  {'段階':<45}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, p in result["stages_ms"].items():
+        print(f"  {name:<45}{p['p50']:>9.2f}{p['p95']:>9.2f}{p['p99']:>9.2f}")
+
+def hit_overlap(current: Dict[str, Dict[str, List[List[Any]]]], baseline: Dict[str, Dict[str, List[List[Any]]]]) -> Tuple[float, int, List[str]]:
+    """共通クエリのヒット一致率（グループ別ヒット集合の重なり / 前回のヒット数）の平均"""
+    ratios, changed = [], []
+    for q in sorted(set(current) & set(baseline)):
+        cur = {(g, tuple(h)) for g, rows in current[q].items() for h in rows}
+        base = {(g, tuple(h)) for g, rows in baseline[q].items() for h in rows}
+        ratio = len(cur & base) / len(base) if base else float(not cur)
+        ratios.append(ratio)
+        if ratio < 1.0:
+            changed.append(q)
+    return (float(np.mean(ratios)) if ratios else 0.0), len(ratios), changed
 
+async def run_benchmark(service, queries: List[str], args) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    for q in queries[:args.warmup]:
+        await service.embed_search(make_request(service, q, args))
+    levels = []
+    for concurrency in args.concurrency:
+        result = await run_level(service, queries, args, concurrency)
+        print_level(result)
+        levels.append(result)
+    explain = await run_explain(service, queries, args)
+    print_explain(explain)
+    return levels, explain
+
+def report_baseline(levels: List[Dict[str, Any]], explain: Dict[str, Any], baseline_path: str) -> None:
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    ratio, n, changed = hit_overlap(explain["hits"], baseline["explain"]["hits"])
+    print(f"\n[INFO] 前回（{baseline_path}）とのヒット一致率: {ratio:.3f}（{n} クエリ / 変化 {len(changed)} クエリ）")
+    for q in changed[:10]:
+        print(f"  - {q}")
+    prev = {lv["concurrency"]: lv for lv in baseline["levels"]}
+    for result in levels:
+        old = prev.get(result["concurrency"])
+        if old is None:
+            continue
+        cur, base = result["latency_ms"], old["latency_ms"]
+        print(
+            f"  同時 {result['concurrency']}: p50 {base['p50']:.1f} → {cur['p50']:.1f}ms / "
+            f"p95 {base['p95']:.1f} → {cur['p95']:.1f}ms / {old['throughput']:.2f} → {result['throughput']:.2f} 件/秒"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="FAISS + SQLite 検索の確認・ベンチマーク（main.py と同じ処理）")
+    parser.add_argument("query", nargs="?", help="1件だけ検索する場合の質問文")
+    parser.add_argument("--query-file", help="質問文（1行1件、# で始まる行は無視）")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1], help="同時クライアント数（複数指定で順に計測）")
+    parser.add_argument("--repeat", type=int, default=1, help="各クエリを何回投げるか")
+    parser.add_argument("--warmup", type=int, default=3, help="計測前に投げるクエリ数")
+    parser.add_argument("--top-k", type=int, default=30)
+    parser.add_argument("--nprobe", type=int)
+    parser.add_argument("--ef-search", type=int)
+    parser.add_argument("--no-hybrid", action="store_true", help="キーワード検索（BM25）を融合しない")
+    parser.add_argument("--no-cross", action="store_true", help="クロスエンコーダーを使わない")
+    parser.add_argument("--cache", action="store_true", help="埋め込み・検索結果キャッシュを有効にしたまま測る（explain の計測は常にキャッシュなし）")
+    parser.add_argument("--save", help="結果（レイテンシ・段階別時間・ヒット）を JSON で保存")
+    parser.add_argument("--baseline", help="--save で保存した前回の結果と比べる")
+    parser.add_argument("-v", "--verbose", action="store_true", help="検索APIのログを表示")
+    args = parser.parse_args()
+    if not args.query and not args.query_file:
+        parser.error("質問文か --query-file を指定してください（例: python3 debugvs.py '検索語句'）")
+
+    service = load_service(args.cache)
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    queries = load_queries(args)
+    generations = dict(zip(service.GROUPS, service.index_generations()))
+    backends = {group: e.name for group, e in service.GROUP_EMBEDDERS.items()}
+    print(f"[INFO] 埋め込み: {backends} / インデックス世代: {generations}")
+
+    if not args.query_file:
+        asyncio.run(run_single(service, queries[0], args))
+        return
+
+    print(
+        f"▶️ debugvs ベンチマーク開始: {len(queries)} クエリ × {args.repeat} 回 / 同時 {args.concurrency} / "
+        f"キャッシュ{'有効' if args.cache else '無効'}"
+    )
+    levels, explain = asyncio.run(run_benchmark(service, queries, args))
+    if args.baseline:
+        report_baseline(levels, explain, args.baseline)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({
+                "embedding_backends": backends,
+                "index_generations": generations,
+                "args": {k: v for k, v in vars(args).items() if k not in ("save", "baseline")},
+                "levels": levels,
+                "explain": explain,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"[INFO] 保存: {args.save}")
+    print("✅ debugvs 完了")
+
+if __name__ == "__main__":
+    main()
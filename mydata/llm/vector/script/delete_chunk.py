@@ -2,6 +2,7 @@
 import json
 from pathlib import Path
 from uid_utils import read_jsonl, write_jsonl_atomic_sync, remove_empty_dirs, extract_uids
+from chunk_store import sync_from_jsonl
 
 # === パス設定 ===
 ROOT = Path("/mydata/llm/vector")
@@ -66,6 +67,7 @@ def main():
     print(f"[INFO] 不要チャンク削除数: {removed}")
 
     rebuild_chunk_log()
+    sync_from_jsonl(CHUNK_DIR)
 
     if removed:
         remove_empty_dirs(CHUNK_DIR, exclude=("calendar",))  # ✅ calendar残す
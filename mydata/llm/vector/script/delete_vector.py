@@ -3,9 +3,13 @@ import os
 import json
 import sqlite3
 from pathlib import Path
-import faiss
 import numpy as np
 
+from faiss_utils import (
+    write_index_atomic, remove_index, load_group_config, build_index, migrate_vector_metadata, backend_label,
+    write_doc_index,
+)
+
 ROOT = Path("/mydata/llm/vector")
 CHUNK_LOG = ROOT / "db/log/chunk_log.jsonl"
 
@@ -38,6 +42,8 @@ def process_config(conf, valid_uid_set):
         return
 
     conn = sqlite3.connect(str(conf["sqlite_path"]))
+    conn.execute("PRAGMA journal_mode=WAL")
+    migrate_vector_metadata(conn)
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
 
@@ -60,8 +66,9 @@ def process_config(conf, valid_uid_set):
         cursor.execute("DELETE FROM vector_metadata")
         conn.commit()
         conn.close()
+        write_doc_index(conf["sqlite_path"], conf["faiss_index"])
         if conf["faiss_index"].exists():
-            conf["faiss_index"].unlink()
+            remove_index(conf["faiss_index"])
             print(f"[DONE] FAISSインデックス削除: {conf['faiss_index']}")
         print("[DONE] DB全削除完了（残件なし）")
         return
@@ -72,7 +79,7 @@ def process_config(conf, valid_uid_set):
     conn.commit()
 
     BATCH_SIZE = 1_000_000
-    new_index = None
+    vectors = []
     vec_index = 0
 
     for i in range(0, len(keep_rows), BATCH_SIZE):
@@ -80,16 +87,15 @@ def process_config(conf, valid_uid_set):
         for r in batch:
             r["vec_index"] = vec_index
             vec = np.frombuffer(r["vector"], dtype=np.float32)
-            if new_index is None:
-                d = len(vec)
-                new_index = faiss.IndexFlatIP(d)
-            new_index.add(np.array([vec], dtype=np.float32))
+            vectors.append(vec)
             cursor.execute(
-                "INSERT INTO vector_metadata (vec_index, uid, chunk_index, path, type, vector) VALUES (?, ?, ?, ?, ?, ?)",
+                "INSERT INTO vector_metadata (vec_index, uid, chunk_index, path, type, vector, mtime, backend) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
                 (
                     vec_index, r["uid"], r["chunk_index"],
                     r["path"], r["type"],
-                    sqlite3.Binary(vec.tobytes())
+                    sqlite3.Binary(vec.tobytes()),
+                    r["mtime"],
+                    r["backend"],
                 )
             )
             vec_index += 1
@@ -97,16 +103,22 @@ def process_config(conf, valid_uid_set):
         print(f"[INFO] 再構成中: {vec_index}件 まで完了")
 
     conn.close()
+    # uid 単位の削除なので、残った文書の重心はそのまま使える（消えた uid の分だけ落とす）
+    write_doc_index(conf["sqlite_path"], conf["faiss_index"])
+
+    new_index, index_params = None, {}
+    if vectors:
+        new_index, index_params = build_index(np.vstack(vectors), load_group_config(conf["name"])["index"])
 
     if new_index is None or new_index.ntotal == 0:
         if conf["faiss_index"].exists():
-            conf["faiss_index"].unlink()
+            remove_index(conf["faiss_index"])
             print(f"[DONE] FAISS削除済み（中身0件）: {conf['faiss_index']}")
         else:
             print("[SKIP] FAISSファイルがもともと存在しない")
         return
 
-    faiss.write_index(new_index, str(conf["faiss_index"]))
+    write_index_atomic(new_index, conf["faiss_index"], **index_params, embedding_backend=backend_label(conf["sqlite_path"]))
     print(f"[DONE] FAISS再構成完了: {conf['faiss_index']}")
     print(f"[DONE] ゴースト削除完了: {len(ghost_uids)} 件")
 
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+embedding_backend.py
+埋め込みモデルの実行方式（検索API／ベクトル登録スクリプトで共用）
+  torch : sentence-transformers（PyTorch fp32、従来どおり）
+  onnx  : ONNX Runtime（export_onnx_int8 で作った動的int8量子化モデル）
+  gguf  : llama.cpp（GGUF の埋め込みモデル）
+グループ設定（vector_config_vector_<group>.json）の "embedding_backend" / "embedding_backend_path" で選ぶ
+どの方式で作ったベクトルかは backend.name として vector_metadata.backend と index.meta.json に残す
+"""
+
+import os
+import json
+import threading
+from pathlib import Path
+from typing import List, Dict, Any, Tuple
+
+import numpy as np
+
+BACKENDS = ("torch", "onnx", "gguf")
+ONNX_META_NAME = "embedding_backend.json"
+ENCODE_THREADS = int(os.getenv("EMBED_THREADS", "0"))  # 0 = ランタイムの既定
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def _read_pooling(model_dir: Path) -> str:
+    """sentence-transformers の 1_Pooling/config.json から pooling 方式（cls / mean）を読む"""
+    path = model_dir / "1_Pooling" / "config.json"
+    if path.exists():
+        with path.open("r", encoding="utf-8") as f:
+            conf = json.load(f)
+        if conf.get("pooling_mode_cls_token"):
+            return "cls"
+    return "mean"
+
+# ====== 1. 実行方式 ======
+class TorchBackend:
+    def __init__(self, model_path: str):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_path).to("cpu")
+        self.name = f"torch:{Path(model_path).name}"
+        self.dim = int(self.model.get_sentence_embedding_dimension())
+
+    def encode(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        vectors = self.model.encode(
+            texts, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True
+        )
+        return np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+
+class OnnxBackend:
+    def __init__(self, model_dir: str):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+        model_dir = Path(model_dir)
+        with (model_dir / ONNX_META_NAME).open("r", encoding="utf-8") as f:
+            meta = json.load(f)
+        onnx_file = model_dir / meta.get("model_file", "model_int8.onnx")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if ENCODE_THREADS:
+            options.intra_op_num_threads = ENCODE_THREADS
+        self.session = ort.InferenceSession(str(onnx_file), options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+        self.pooling = meta.get("pooling", "cls")
+        self.max_length = int(meta.get("max_length", 512))
+        self.dim = int(meta["dim"])
+        self.name = f"onnx:{model_dir.name}/{onnx_file.stem}"
+
+    def encode(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        out = []
+        for i in range(0, len(texts), batch_size):
+            enc = self.tokenizer(
+                texts[i:i + batch_size], padding=True, truncation=True,
+                max_length=self.max_length, return_tensors="np",
+            )
+            feeds = {k: v.astype(np.int64) for k, v in enc.items() if k in self.input_names}
+            hidden = self.session.run(None, feeds)[0]
+            if self.pooling == "cls":
+                pooled = hidden[:, 0]
+            else:
+                mask = enc["attention_mask"][..., None].astype(np.float32)
+                pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            out.append(pooled)
+        if not out:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return _normalize(np.vstack(out))
+
+class GgufBackend:
+    def __init__(self, model_path: str):
+        from llama_cpp import Llama
+        self.llm = Llama(
+            model_path=model_path,
+            embedding=True,
+            n_ctx=int(os.getenv("EMBED_GGUF_CONTEXT_SIZE", "8192")),
+            n_threads=ENCODE_THREADS or None,
+            verbose=False,
+        )
+        self._lock = threading.Lock()  # Llama インスタンスは同時に呼べない
+        self.name = f"gguf:{Path(model_path).name}"
+        self.dim = int(self.llm.n_embd())
+
+    def encode(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        with self._lock:
+            vectors = self.llm.embed(list(texts))
+        return _normalize(np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1))
+
+def load_backend(backend: str, model_path: str, backend_path: str = ""):
+    """backend: torch / onnx / gguf。onnx・gguf は backend_path（変換済みモデル）を使う"""
+    if backend == "torch":
+        return TorchBackend(model_path)
+    if backend not in BACKENDS:
+        raise ValueError(f"未対応の埋め込みバックエンド: {backend}")
+    if not backend_path:
+        raise ValueError(f"embedding_backend_path が未指定です（{backend}）")
+    if backend == "onnx":
+        return OnnxBackend(backend_path)
+    return GgufBackend(backend_path)
+
+def backend_spec(conf: Dict[str, Any]) -> Tuple[str, str, str]:
+    """load_group_config() の結果 → load_backend の引数 (backend, model_path, backend_path)（環境変数 EMBED_BACKEND / EMBED_BACKEND_PATH で上書き可）"""
+    return (
+        os.getenv("EMBED_BACKEND", conf["embedding_backend"]),
+        conf["embedding_model"],
+        os.getenv("EMBED_BACKEND_PATH", conf.get("embedding_backend_path", "")),
+    )
+
+def load_backend_from_config(conf: Dict[str, Any]):
+    """load_group_config() の結果から読み込む"""
+    return load_backend(*backend_spec(conf))
+
+# ====== 2. ONNX 変換（動的int8量子化） ======
+def export_onnx_int8(model_path: str, out_dir: str, opset: int = 17) -> Path:
+    """sentence-transformers のモデルを ONNX に書き出し、重みを int8 に動的量子化する"""
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    st = SentenceTransformer(model_path, device="cpu")
+    hf_model = st[0].auto_model
+    hf_model.config.return_dict = False
+    hf_model.eval()
+    dummy = st.tokenizer(["埋め込みモデルの変換"], return_tensors="pt")
+
+    fp32_path = out_dir / "model.onnx"
+    with torch.no_grad():
+        torch.onnx.export(
+            hf_model,
+            (dummy["input_ids"], dummy["attention_mask"]),
+            str(fp32_path),
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "seq"},
+                "attention_mask": {0: "batch", 1: "seq"},
+                "last_hidden_state": {0: "batch", 1: "seq"},
+            },
+            opset_version=opset,
+        )
+    int8_path = out_dir / "model_int8.onnx"
+    # bge-m3 等は fp32 で 2GB を超えるため外部データ形式で保存する
+    quantize_dynamic(str(fp32_path), str(int8_path), weight_type=QuantType.QInt8, use_external_data_format=True)
+
+    st.tokenizer.save_pretrained(str(out_dir))
+    with (out_dir / ONNX_META_NAME).open("w", encoding="utf-8") as f:
+        json.dump({
+            "model_file": int8_path.name,
+            "source_model": str(model_path),
+            "pooling": _read_pooling(Path(model_path)),
+            "max_length": int(st.max_seq_length),
+            "dim": int(st.get_sentence_embedding_dimension()),
+        }, f, ensure_ascii=False, indent=2)
+    return out_dir
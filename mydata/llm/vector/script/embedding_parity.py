@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+embedding_parity.py
+別の埋め込みバックエンド（onnx / gguf）に切り替える前に、PyTorch（torch）のベクトルとのずれを確認する
+チャンクストアから本文を抜き出して両方で埋め込み、コサイン類似度・近傍の一致率・1件あたり時間を表示する
+
+使用方法:
+  python3 embedding_parity.py onnx --export /mydata/llm/vector/models/legal-bge-m3-onnx   # int8 変換してから比較
+  python3 embedding_parity.py onnx --path /mydata/llm/vector/models/legal-bge-m3-onnx
+  python3 embedding_parity.py gguf --path /mydata/llm/vector/models/bge-m3-Q8_0.gguf --texts 500
+切り替えは vector_config_vector_<group>.json の "embedding_backend" / "embedding_backend_path"（要再ベクトル化）
+"""
+
+import sys
+import time
+import sqlite3
+import argparse
+
+import numpy as np
+
+from faiss_utils import load_group_config
+from chunk_store import STORE_PATH
+from embedding_backend import TorchBackend, load_backend, export_onnx_int8
+
+def sample_texts(args):
+    if args.text_file:
+        with open(args.text_file, encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip()][:args.texts]
+    if not STORE_PATH.exists():
+        print(f"[ERROR] チャンクストアが存在しません: {STORE_PATH}（--text-file を指定）")
+        sys.exit(1)
+    with sqlite3.connect(str(STORE_PATH)) as conn:
+        rows = conn.execute(
+            "SELECT text FROM chunks WHERE length(trim(text)) > 0 ORDER BY random() LIMIT ?", (args.texts,)
+        ).fetchall()
+    return [r[0] for r in rows]
+
+def timed_encode(backend, texts, batch_size):
+    started = time.perf_counter()
+    vectors = backend.encode(texts, batch_size=batch_size)
+    return vectors, (time.perf_counter() - started) * 1000 / max(1, len(texts))
+
+def neighbour_overlap(a: np.ndarray, b: np.ndarray, k: int) -> float:
+    """サンプル内の上位 k 近傍がどれだけ一致するか（検索結果の変わりにくさの目安）"""
+    k = min(k, len(a) - 1)
+    if k <= 0:
+        return 1.0
+    sa, sb = a @ a.T, b @ b.T
+    np.fill_diagonal(sa, -np.inf)
+    np.fill_diagonal(sb, -np.inf)
+    top_a = np.argpartition(-sa, k, axis=1)[:, :k]
+    top_b = np.argpartition(-sb, k, axis=1)[:, :k]
+    return float(np.mean([len(set(x) & set(y)) / k for x, y in zip(top_a, top_b)]))
+
+def main():
+    parser = argparse.ArgumentParser(description="埋め込みバックエンドの PyTorch との差分確認")
+    parser.add_argument("backend", choices=["onnx", "gguf"])
+    parser.add_argument("--path", help="変換済みモデル（onnx: フォルダー / gguf: ファイル）")
+    parser.add_argument("--export", metavar="OUT_DIR", help="onnx: PyTorch モデルを int8 ONNX に変換して OUT_DIR に保存")
+    parser.add_argument("--group", default="pdf_word", choices=["pdf_word", "excel_calendar"], help="embedding_model を読むグループ設定")
+    parser.add_argument("--texts", type=int, default=200, help="比較する本文数")
+    parser.add_argument("--text-file", help="本文（1行1件）。未指定はチャンクストアから無作為抽出")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--k", type=int, default=10, help="近傍一致率の k")
+    parser.add_argument("--min-cosine", type=float, default=0.99, help="最小コサインの合格ライン")
+    args = parser.parse_args()
+
+    model_path = load_group_config(args.group)["embedding_model"]
+    backend_path = args.path
+    if args.export:
+        if args.backend != "onnx":
+            parser.error("--export は onnx のみ")
+        print(f"▶️ ONNX int8 変換: {model_path} → {args.export}")
+        backend_path = str(export_onnx_int8(model_path, args.export))
+    if not backend_path:
+        parser.error("--path か --export を指定してください")
+
+    texts = sample_texts(args)
+    if not texts:
+        print("[INFO] 比較する本文なし")
+        return
+    print(f"▶️ embedding_parity 開始: torch vs {args.backend}（{len(texts)} 件）")
+
+    reference = TorchBackend(model_path)
+    candidate = load_backend(args.backend, model_path, backend_path)
+    ref_vecs, ref_ms = timed_encode(reference, texts, args.batch_size)
+    cand_vecs, cand_ms = timed_encode(candidate, texts, args.batch_size)
+    if ref_vecs.shape != cand_vecs.shape:
+        print(f"[ERROR] 次元が違います: torch={ref_vecs.shape[1]} / {candidate.name}={cand_vecs.shape[1]}")
+        sys.exit(1)
+
+    cos = np.sum(ref_vecs * cand_vecs, axis=1)
+    print(f"[INFO] バックエンド: {reference.name} / {candidate.name}（次元 {ref_vecs.shape[1]}）")
+    print(f"[INFO] コサイン 平均 {cos.mean():.5f} / 最小 {cos.min():.5f} / p1 {np.percentile(cos, 1):.5f} / p5 {np.percentile(cos, 5):.5f}")
+    print(f"[INFO] 近傍一致率@{args.k}: {neighbour_overlap(ref_vecs, cand_vecs, args.k):.3f}")
+    print(f"[INFO] 1件あたり: torch {ref_ms:.1f}ms / {args.backend} {cand_ms:.1f}ms（{ref_ms / max(cand_ms, 1e-9):.2f}倍）")
+    if cos.min() >= args.min_cosine:
+        print(f"✅ 合格（最小コサイン ≥ {args.min_cosine}）: embedding_backend=\"{args.backend}\" / embedding_backend_path=\"{backend_path}\"")
+    else:
+        print(f"⚠️ ずれが大きい本文があります（最小コサイン < {args.min_cosine}）")
+
+if __name__ == "__main__":
+    main()
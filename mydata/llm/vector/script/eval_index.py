@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+eval_index.py
+保存済みベクトル（vector_metadata.vector）から各インデックス種別を作り、
+flat（全件探索）と比べたメモリ量・再現率・1件あたり検索時間を表示する
+再採点はサービス（main.py）と同じく候補の float ベクトルを SQLite から引いて行い、その時間も1件あたり時間に含める
+--reduce を指定すると次元削減（PCA / 切り詰め）した flat も同じ表で元の次元の flat と比べる
+
+使用方法:
+  python3 eval_index.py excel_calendar --types sq8 pq ivf_pq --k 50
+  python3 eval_index.py excel_calendar --types binary --k 50   # 1bit＋float再採点の再現率・時間
+  python3 eval_index.py pdf_word --query-file queries.txt   # 実際の質問文で評価
+  python3 eval_index.py pdf_word --types --reduce pca:256 pca:512 truncate:512
+"""
+
+import sys
+import time
+import sqlite3
+import argparse
+
+import faiss
+import numpy as np
+
+from faiss_utils import (
+    ROOT, COMPRESSED_TYPES, SignBinaryIndex, load_group_config, load_stored_vectors, build_index,
+    fetch_stored_vectors, rescore,
+)
+
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024  # main.py の既定値と同じ
+
+def index_bytes(index) -> int:
+    if isinstance(index, SignBinaryIndex):
+        return len(faiss.serialize_index_binary(index.binary))
+    return len(faiss.serialize_index(index))
+
+def load_queries(args, vectors: np.ndarray) -> np.ndarray:
+    if args.query_file:
+        from embedding_backend import load_backend_from_config
+        with open(args.query_file, encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()]
+        return load_backend_from_config(load_group_config(args.group)).encode(texts)
+    rng = np.random.default_rng(args.seed)
+    n = min(args.queries, len(vectors))
+    return vectors[rng.choice(len(vectors), n, replace=False)]
+
+def open_readonly(sqlite_path) -> sqlite3.Connection:
+    """サービスと同じ読み取り専用接続（mmap 付き）"""
+    conn = sqlite3.connect(f"file:{sqlite_path}?mode=ro", uri=True)
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    return conn
+
+def search_all(
+    index, queries: np.ndarray, k: int, n_total: int,
+    conn: sqlite3.Connection = None, rescore_factor: int = 0, candidates: int = 0,
+):
+    """
+    サービスと同じく1件ずつ検索（再採点ありなら max(k × 倍率, candidates) 件の float ベクトルを
+    SQLite から引いて並べ直す）。戻り値: (結果, 1件あたり ms, うち再採点 ms)
+    """
+    results = []
+    n_fetch = min(n_total, max(k * rescore_factor, candidates)) if rescore_factor else k
+    rescore_sec = 0.0
+    started = time.perf_counter()
+    for q in queries:
+        q = q.reshape(1, -1)
+        _, I = index.search(q, n_fetch)
+        ids = I[0][I[0] >= 0]
+        if rescore_factor:
+            rescore_started = time.perf_counter()
+            _, I = rescore(q[0], ids, fetch_stored_vectors(conn, ids), k)
+            ids = I[0]
+            rescore_sec += time.perf_counter() - rescore_started
+        results.append(ids[:k])
+    n = max(1, len(queries))
+    return results, (time.perf_counter() - started) * 1000 / n, rescore_sec * 1000 / n
+
+def parse_reduce(spec: str):
+    """"pca:256" → ("pca", 256)"""
+    method, _, dim = spec.partition(":")
+    if method not in ("pca", "truncate") or not dim.isdigit():
+        raise argparse.ArgumentTypeError(f"pca:次元 / truncate:次元 の形式で指定してください: {spec}")
+    return method, int(dim)
+
+def recall(results, truth, k: int) -> float:
+    return float(np.mean([len(set(r.tolist()) & set(t.tolist())) / k for r, t in zip(results, truth)]))
+
+def main():
+    parser = argparse.ArgumentParser(description="FAISSインデックス種別のメモリ・再現率比較")
+    parser.add_argument("group", choices=["pdf_word", "excel_calendar"])
+    parser.add_argument("--types", nargs="*", default=["sq8", "pq", "ivf_sq8", "ivf_pq", "binary"])
+    parser.add_argument("--reduce", nargs="*", type=parse_reduce, default=[], help="次元削減（例: pca:256 truncate:512）")
+    parser.add_argument("--k", type=int, default=50)
+    parser.add_argument("--queries", type=int, default=200, help="保存済みベクトルから抜き出すクエリ数")
+    parser.add_argument("--query-file", help="質問文（1行1件）。指定時はモデルで埋め込んで使う")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    sqlite_path = ROOT / f"db/faiss/{args.group}/metadata.sqlite3"
+    if not sqlite_path.exists():
+        print(f"[ERROR] SQLiteが存在しません: {sqlite_path}")
+        sys.exit(1)
+
+    print(f"▶️ eval_index 開始: {args.group}")
+    vectors = load_stored_vectors(sqlite_path)
+    if len(vectors) == 0:
+        print("[INFO] ベクトルなし")
+        return
+    queries = load_queries(args, vectors)
+    k = min(args.k, len(vectors))
+    index_conf = load_group_config(args.group)["index"]
+    print(f"[INFO] 件数: {len(vectors)} / 次元: {vectors.shape[1]} / クエリ: {len(queries)} / k={k}")
+
+    flat, _ = build_index(vectors, {**index_conf, "type": "flat", "reduce": "none"})
+    conn = open_readonly(sqlite_path)
+    truth, flat_ms, _ = search_all(flat, queries, k, len(vectors))
+    flat_bytes = index_bytes(flat)
+
+    print(f"\n{'種別':<10}{'メモリMB':>10}{'対flat':>9}{'recall@k':>10}{'再採点後':>10}{'ms/件':>9}{'うち再採点':>11}")
+    print(f"{'flat':<10}{flat_bytes / 2**20:>10.1f}{1.0:>9.2f}{1.0:>10.3f}{'-':>10}{flat_ms:>9.2f}{'-':>11}")
+    variants = [(t, {"type": t, "reduce": "none"}) for t in args.types]
+    variants += [
+        (f"{method}{dim}", {"type": "flat", "reduce": method, "reduce_dim": dim})
+        for method, dim in args.reduce
+    ]
+    for label, overrides in variants:
+        try:
+            index, params = build_index(vectors, {**index_conf, **overrides, "min_train_size": 0})
+        except Exception as e:
+            print(f"{label:<10}[ERROR] {e}")
+            continue
+        if overrides["reduce"] != "none" and "reduce" not in params:
+            print(f"{label:<10}[WARN] 元の次元（{vectors.shape[1]}）以上のため削減なし")
+            continue
+        size = index_bytes(index)
+        raw, ms, _ = search_all(index, queries, k, len(vectors))
+        factor = int(params.get("rescore_factor", 0)) if label in COMPRESSED_TYPES or "reduce" in params else 0
+        rescored_recall, rescore_ms = "-", "-"
+        if factor:
+            rescored, ms, part_ms = search_all(
+                index, queries, k, len(vectors), conn,
+                rescore_factor=factor, candidates=int(params.get("rescore_candidates", 0)),
+            )
+            rescored_recall, rescore_ms = f"{recall(rescored, truth, k):.3f}", f"{part_ms:.2f}"
+        print(
+            f"{label:<10}{size / 2**20:>10.1f}{size / flat_bytes:>9.2f}"
+            f"{recall(raw, truth, k):>10.3f}{rescored_recall:>10}{ms:>9.2f}{rescore_ms:>11}"
+        )
+    conn.close()
+
+    print(f"\n[INFO] 参考: SQLite内 float ベクトル {vectors.nbytes / 2**20:.1f} MB（再採点に使用）")
+    print("✅ eval_index 完了")
+
+if __name__ == "__main__":
+    main()
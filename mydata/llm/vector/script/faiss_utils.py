@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+faiss_utils.py
+FAISSインデックスの保存・世代管理（ベクトル登録スクリプト／検索APIで共用）
+"""
+
+import os
+import json
+import math
+import time
+import sqlite3
+from pathlib import Path
+from typing import Dict, Any, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from uid_utils import get_source_mtime
+
+ROOT = Path("/mydata/llm/vector")
+META_NAME = "index.meta.json"
+TRANSFORM_NAME = "transform.faiss"   # 次元削減（PCA / 切り詰め）の変換行列。index.faiss と同じフォルダー
+DOC_INDEX_NAME = "doc_index.faiss"   # 文書単位（uid ごとの重心）のインデックス。index.faiss と同じフォルダー
+
+# グループ設定（vector_config_vector_<group>.json の "index" で上書き）
+DEFAULT_INDEX_CONFIG: Dict[str, Any] = {
+    "type": "flat",            # flat / ivf / hnsw / sq8 / pq / ivf_sq8 / ivf_pq / binary
+    "nlist": 0,                # IVFのセントロイド数（0 = √件数×4 で自動）
+    "nprobe": 16,              # IVFの検索時に見るセントロイド数
+    "hnsw_m": 32,
+    "ef_construction": 200,
+    "ef_search": 64,
+    "min_train_size": 10000,   # これ未満の件数なら flat のまま
+    "train_sample": 100000,    # 学習に使う最大サンプル数
+    "pq_m": 64,                # PQのサブベクトル数（1件あたり pq_m バイト）
+    "rescore_factor": 4,       # 圧縮インデックス・次元削減: top_k × この倍数を取り、保存済みfloatベクトルで再採点
+    "binary_candidates": 2000, # binary: 再採点する候補の最小件数（ハミング距離は粗いため多めに取る）
+    "reduce": "none",          # 次元削減: none / pca / truncate（truncate は Matryoshka 学習済みモデル向け）
+    "reduce_dim": 0,           # 削減後の次元数（0 または元の次元以上なら削減しない）
+}
+
+# 埋め込みモデル・実行方式（embedding_backend.py）
+DEFAULT_EMBED_CONFIG: Dict[str, Any] = {
+    "embedding_model": "/mydata/llm/vector/models/legal-bge-m3",
+    "embedding_backend": "torch",      # torch / onnx / gguf
+    "embedding_backend_path": "",      # onnx: export_onnx_int8 の出力フォルダー / gguf: モデルファイル
+}
+
+# 量子化で近似スコアになる種別（検索後に SQLite の float ベクトルで再採点する）
+COMPRESSED_TYPES = ("sq8", "pq", "ivf_sq8", "ivf_pq", "binary")
+BINARY_FOURCC = b"IB"  # faiss.write_index_binary で書いたファイルの先頭（IBxF 等）
+
+# ====== 1. 世代マーカー ======
+def meta_path(index_path: Path) -> Path:
+    return Path(index_path).with_name(META_NAME)
+
+def read_index_meta(index_path: Path) -> Dict[str, Any]:
+    path = meta_path(index_path)
+    if not path.exists():
+        return {}
+    try:
+        with path.open("r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def bump_generation(index_path: Path, reset: bool = False, **extra) -> int:
+    """
+    index.faiss と同じフォルダーの index.meta.json の世代番号を進める
+    検索API側はこのファイルの変化を見てインデックスを差し替える
+    reset=True の場合は世代番号以外の項目を extra で置き換える
+    """
+    meta = read_index_meta(index_path)
+    if reset:
+        meta = {"generation": meta.get("generation", 0)}
+    meta.update(extra)
+    meta["generation"] = int(meta.get("generation", 0)) + 1
+    meta["updated_at"] = time.time()
+
+    path = meta_path(index_path)
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with tmp_path.open("w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return meta["generation"]
+
+# ====== 2. インデックス保存・削除 ======
+def transform_path(index_path: Path) -> Path:
+    return Path(index_path).with_name(TRANSFORM_NAME)
+
+def write_index_atomic(index, index_path: Path, **extra) -> int:
+    """
+    一時ファイルに書き出してから os.replace で差し替える
+    （読み込み中のプロセスが書きかけのファイルを見ないようにする）
+    次元削減つき（IndexPreTransform）は変換行列を transform.faiss、削減後のインデックスを index.faiss に分けて保存
+    """
+    index_path = Path(index_path)
+    t_path = transform_path(index_path)
+    if isinstance(index, SignBinaryIndex):
+        write, index = faiss.write_index_binary, index.binary
+    else:
+        write = faiss.write_index
+    if isinstance(index, faiss.IndexPreTransform):
+        tmp_path = t_path.with_suffix(t_path.suffix + ".tmp")
+        faiss.write_VectorTransform(faiss.downcast_VectorTransform(index.chain.at(0)), str(tmp_path))
+        os.replace(tmp_path, t_path)
+        index = faiss.downcast_index(index.index)
+    elif t_path.exists():
+        t_path.unlink()
+    tmp_path = index_path.with_suffix(index_path.suffix + ".tmp")
+    write(index, str(tmp_path))
+    os.replace(tmp_path, index_path)
+    return bump_generation(index_path, reset=True, ntotal=int(index.ntotal), **extra)
+
+def _ondisk_lists(index) -> bool:
+    """IVF の転置リストが mmap（OnDiskInvertedLists）で開かれているか"""
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except Exception:
+        return False
+    return isinstance(faiss.downcast_InvertedLists(ivf.invlists), faiss.OnDiskInvertedLists)
+
+def read_index(index_path: Path, mmap: bool = False) -> Tuple[Any, str]:
+    """
+    mmap=True の場合は FAISS の mmap 読み込みを試す
+      1. IO_FLAG_MMAP_IFC 付き（flat / HNSW / SQ / PQ / binary。ファイル内のデータをそのまま参照）
+      2. IFC なし（IVF 系は IFC 非対応。転置リストを OnDiskInvertedLists として mmap）
+      3. どちらも失敗したら通常読み込み
+    os.replace で差し替えられても、開いている側は旧ファイルの中身を参照し続ける
+    binary（ファイル先頭で判定）は SignBinaryIndex に包んで返す
+    戻り値: (インデックス, mmap 方式)。方式は "ifc" / "ondisk"、実際に mmap されていなければ ""
+    """
+    with open(index_path, "rb") as f:
+        is_binary = f.read(len(BINARY_FOURCC)) == BINARY_FOURCC
+    reader = faiss.read_index_binary if is_binary else faiss.read_index
+    wrap = SignBinaryIndex if is_binary else (lambda index: index)
+    if mmap:
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        ifc = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+        if ifc:
+            try:
+                return wrap(reader(str(index_path), flags | ifc)), "ifc"
+            except Exception:
+                pass  # IVF 系 → IFC なしで再試行
+        try:
+            index = reader(str(index_path), flags)
+        except Exception as e:
+            print(f"[WARN] mmap 読み込み不可（メモリ展開）: {index_path} → {str(e).splitlines()[0]}")
+        else:
+            # IFC なしで mmap されるのは IVF の転置リストだけ（それ以外はメモリに読み込まれている）
+            return wrap(index), "ondisk" if not is_binary and _ondisk_lists(index) else ""
+    return wrap(reader(str(index_path))), ""
+
+def read_transform(index_path: Path) -> Optional[Any]:
+    """transform.faiss（次元削減なしのグループは None）"""
+    path = transform_path(index_path)
+    if not path.exists():
+        return None
+    return faiss.read_VectorTransform(str(path))
+
+def read_index_for_update(index_path: Path):
+    """追加登録用の読み込み。次元削減ありなら変換と組にして返す（add に元の次元のベクトルを渡せる）"""
+    index, _ = read_index(index_path)
+    transform = read_transform(index_path)
+    return wrap_transform(transform, index) if transform is not None else index
+
+def remove_index(index_path: Path) -> int:
+    index_path = Path(index_path)
+    if index_path.exists():
+        index_path.unlink()
+    for path in (transform_path(index_path), doc_index_path(index_path)):
+        if path.exists():
+            path.unlink()
+    return bump_generation(index_path, reset=True, ntotal=0)
+
+# ====== 3. グループ設定 ======
+def load_group_config(group: str) -> Dict[str, Any]:
+    path = ROOT / f"vector_config_vector_{group}.json"
+    conf: Dict[str, Any] = {}
+    if path.exists():
+        with path.open("r", encoding="utf-8") as f:
+            conf = json.load(f)
+    conf["index"] = {**DEFAULT_INDEX_CONFIG, **conf.get("index", {})}
+    for key, value in DEFAULT_EMBED_CONFIG.items():
+        conf.setdefault(key, value)
+    return conf
+
+# ====== 4. インデックス生成（flat / IVF / HNSW / binary） ======
+class SignBinaryIndex:
+    """
+    1bit 符号量子化（各次元の正負のみ）＋ハミング距離の全件探索（faiss.IndexBinaryFlat を包む）
+    float インデックスと同じく add / search に float ベクトルを渡せるようにする
+    search のスコアは符号の一致度 (d - 2×ハミング距離) / d（近似のため必ず float で再採点する）
+    """
+
+    def __init__(self, binary_index):
+        self.binary = binary_index
+
+    @classmethod
+    def create(cls, dim: int) -> "SignBinaryIndex":
+        if dim % 8:
+            raise ValueError(f"binary は次元数が8の倍数である必要があります: {dim}")
+        return cls(faiss.IndexBinaryFlat(dim))
+
+    @property
+    def d(self) -> int:
+        return self.binary.d
+
+    @property
+    def ntotal(self) -> int:
+        return self.binary.ntotal
+
+    @property
+    def is_trained(self) -> bool:
+        return True
+
+    @staticmethod
+    def pack(vectors: np.ndarray) -> np.ndarray:
+        return np.packbits(np.asarray(vectors) > 0, axis=1)
+
+    def add(self, vectors: np.ndarray) -> None:
+        self.binary.add(self.pack(vectors))
+
+    def search(self, vectors: np.ndarray, k: int, params=None) -> Tuple[np.ndarray, np.ndarray]:
+        D, I = self.binary.search(self.pack(vectors), k, params=params)
+        return (self.d - 2 * D.astype(np.float32)) / self.d, I
+
+def _base_index(index):
+    """種別判定用の実体（SignBinaryIndex はそのまま返す）"""
+    return index if isinstance(index, SignBinaryIndex) else faiss.downcast_index(index)
+
+def resolve_index_type(index_conf: Dict[str, Any], ntotal: int) -> str:
+    index_type = index_conf.get("type", "flat")
+    if index_type != "flat" and ntotal < int(index_conf["min_train_size"]):
+        return "flat"
+    return index_type
+
+def resolve_reduce(index_conf: Dict[str, Any], dim: int, ntotal: int) -> Tuple[str, int]:
+    """
+    実際に使う次元削減 (方式, 削減後の次元)。削減しない場合は ("none", 0)
+    PCA は学習が必要なため min_train_size 未満の件数では行わない（truncate は件数によらない）
+    binary は IndexPreTransform で包めないため削減しない
+    """
+    method = index_conf.get("reduce", "none")
+    out_dim = int(index_conf.get("reduce_dim", 0))
+    if method == "none" or not 0 < out_dim < dim or resolve_index_type(index_conf, ntotal) == "binary":
+        return "none", 0
+    if method not in ("pca", "truncate"):
+        raise ValueError(f"未対応の次元削減: {method}")
+    if method == "pca" and ntotal < max(out_dim, int(index_conf["min_train_size"])):
+        return "none", 0
+    return method, out_dim
+
+def layout_matches(meta: Dict[str, Any], index_conf: Dict[str, Any], dim: int, ntotal: int) -> bool:
+    """index.meta.json の種別・次元削減が、設定と件数から決まるものと同じか（違えば全件から作り直す）"""
+    if meta.get("index_type", "flat") != resolve_index_type(index_conf, ntotal):
+        return False
+    return (meta.get("reduce", "none"), int(meta.get("reduce_dim", 0))) == resolve_reduce(index_conf, dim, ntotal)
+
+def create_transform(method: str, dim: int, out_dim: int):
+    """pca: 保存済みベクトルで学習する主成分射影 / truncate: 先頭 out_dim 次元をそのまま使う"""
+    if method == "pca":
+        return faiss.PCAMatrix(dim, out_dim)
+    return faiss.RemapDimensionsTransform(dim, out_dim, False)
+
+def wrap_transform(transform, index):
+    """削減 → L2正規化 → index の順に通す（train / add / search がすべて元の次元のベクトルを受け取る）"""
+    wrapped = faiss.IndexPreTransform(faiss.NormalizationTransform(transform.d_out, 2.0), index)
+    wrapped.prepend_transform(transform)
+    return wrapped
+
+def apply_transform(transform, vectors: np.ndarray) -> np.ndarray:
+    """検索クエリへの次元削減（登録時の wrap_transform と同じく削減後に L2 正規化）"""
+    if transform is None:
+        return vectors
+    reduced = transform.apply(np.ascontiguousarray(vectors, dtype=np.float32))
+    faiss.normalize_L2(reduced)
+    return reduced
+
+def _pq_m(dim: int, pq_m: int) -> int:
+    """dim を割り切れる最大のサブベクトル数"""
+    m = max(1, min(dim, int(pq_m)))
+    while dim % m:
+        m -= 1
+    return m
+
+def create_index(index_conf: Dict[str, Any], dim: int, ntotal: int) -> Tuple[Any, Dict[str, Any]]:
+    """設定と件数からインデックスを作る。戻り値: (未学習インデックス, meta に残すパラメータ)"""
+    index_type = resolve_index_type(index_conf, ntotal)
+    nlist = int(index_conf["nlist"]) or int(min(65536, max(16, 4 * math.sqrt(max(1, ntotal)))))
+    params: Dict[str, Any] = {"index_type": index_type}
+    if index_type in COMPRESSED_TYPES:
+        params["rescore_factor"] = int(index_conf["rescore_factor"])
+
+    if index_type == "ivf":
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        index.nprobe = int(index_conf["nprobe"])
+        return index, {**params, "nlist": nlist, "nprobe": index.nprobe}
+    if index_type == "sq8":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        return index, params
+    if index_type == "pq":
+        m = _pq_m(dim, index_conf["pq_m"])
+        return faiss.IndexPQ(dim, m, 8, faiss.METRIC_INNER_PRODUCT), {**params, "pq_m": m}
+    if index_type in ("ivf_sq8", "ivf_pq"):
+        m = _pq_m(dim, index_conf["pq_m"])
+        codec = "SQ8" if index_type == "ivf_sq8" else f"PQ{m}"
+        index = faiss.index_factory(dim, f"IVF{nlist},{codec}", faiss.METRIC_INNER_PRODUCT)
+        faiss.extract_index_ivf(index).nprobe = int(index_conf["nprobe"])
+        params.update(nlist=nlist, nprobe=int(index_conf["nprobe"]))
+        if index_type == "ivf_pq":
+            params["pq_m"] = m
+        return index, params
+    if index_type == "binary":
+        # 1件あたり dim/8 バイト（float の 1/32）。候補は top_k × 倍率 と binary_candidates の大きい方
+        return SignBinaryIndex.create(dim), {**params, "rescore_candidates": int(index_conf["binary_candidates"])}
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, int(index_conf["hnsw_m"]), faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = int(index_conf["ef_construction"])
+        index.hnsw.efSearch = int(index_conf["ef_search"])
+        return index, {
+            **params,
+            "hnsw_m": int(index_conf["hnsw_m"]),
+            "ef_search": int(index_conf["ef_search"]),
+        }
+    if index_type != "flat":
+        raise ValueError(f"未対応のインデックス種別: {index_type}")
+    return faiss.IndexFlatIP(dim), params
+
+def build_index(vectors: np.ndarray, index_conf: Dict[str, Any]) -> Tuple[Any, Dict[str, Any]]:
+    """
+    全ベクトルから作り直す（必要なら学習用サンプルで train してから add）
+    次元削減ありの場合は IndexPreTransform を返す（write_index_atomic が変換行列を別ファイルに保存）
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    method, out_dim = resolve_reduce(index_conf, vectors.shape[1], len(vectors))
+    index, params = create_index(index_conf, out_dim or vectors.shape[1], len(vectors))
+    if method != "none":
+        index = wrap_transform(create_transform(method, vectors.shape[1], out_dim), index)
+        # 削減後の内積は近似スコアのため、圧縮インデックスと同じく float ベクトルで再採点する
+        params.update(reduce=method, reduce_dim=out_dim, rescore_factor=int(index_conf["rescore_factor"]))
+    if not index.is_trained:
+        n_sample = min(len(vectors), int(index_conf["train_sample"]))
+        rng = np.random.default_rng(0)
+        sample = vectors[np.sort(rng.choice(len(vectors), n_sample, replace=False))]
+        index.train(sample)
+        params["train_size"] = n_sample
+    index.add(vectors)
+    return index, params
+
+def load_stored_vectors(sqlite_path: Path) -> np.ndarray:
+    """vector_metadata の vector BLOB を vec_index 順に読み出す（FAISS の ID = 行番号）"""
+    with sqlite3.connect(str(sqlite_path)) as conn:
+        rows = conn.execute("SELECT vector FROM vector_metadata ORDER BY vec_index").fetchall()
+    if not rows:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.vstack([np.frombuffer(r[0], dtype=np.float32) for r in rows])
+
+def rebuild_index_from_sqlite(sqlite_path: Path, index_conf: Dict[str, Any]) -> Tuple[Optional[Any], Dict[str, Any]]:
+    vectors = load_stored_vectors(sqlite_path)
+    if len(vectors) == 0:
+        return None, {}
+    return build_index(vectors, index_conf)
+
+# ====== 5. 検索パラメータ ======
+def apply_index_params(index, meta: Dict[str, Any]) -> None:
+    """meta に保存された検索既定値（nprobe / efSearch）を読み込んだインデックスへ反映"""
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexIVF) and meta.get("nprobe"):
+        base.nprobe = int(meta["nprobe"])
+    if isinstance(base, faiss.IndexHNSW) and meta.get("ef_search"):
+        base.hnsw.efSearch = int(meta["ef_search"])
+
+def make_search_params(index, nprobe: Optional[int] = None, ef_search: Optional[int] = None, sel=None):
+    """
+    リクエスト単位の検索パラメータ（共有インデックスの設定は書き換えない）
+    sel: faiss.IDSelector（絞り込み検索。検索が終わるまで呼び出し側で参照を保持すること）
+    """
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexIVF) and (nprobe or sel is not None):
+        params = faiss.SearchParametersIVF(sel=sel) if sel is not None else faiss.SearchParametersIVF()
+        params.nprobe = int(nprobe) if nprobe else base.nprobe
+        return params
+    if isinstance(base, faiss.IndexHNSW) and (ef_search or sel is not None):
+        params = faiss.SearchParametersHNSW(sel=sel) if sel is not None else faiss.SearchParametersHNSW()
+        params.efSearch = int(ef_search) if ef_search else base.hnsw.efSearch
+        return params
+    if sel is not None:
+        return faiss.SearchParameters(sel=sel)
+    return None
+
+def supports_id_selector(index) -> bool:
+    """IDSelector で絞り込み検索できるか（IndexPQ は未対応）"""
+    return not isinstance(_base_index(index), faiss.IndexPQ)
+
+def search_ids_exact(index, query: np.ndarray, ids: np.ndarray, k: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    ids の中だけをインデックス内の float ベクトルで全件採点し (D, I) を返す
+    flat は IDSelector、IVF-Flat は全リスト探索＋IDSelector、HNSW-Flat は格納側の flat を IDSelector で検索
+    圧縮インデックスは近似値しか持たないので None（保存済みベクトルで採点すること）
+    """
+    base = _base_index(index)
+    sel = faiss.IDSelectorBatch(ids)
+    if isinstance(base, faiss.IndexHNSWFlat):
+        base = faiss.downcast_index(base.storage)
+    if isinstance(base, faiss.IndexFlat):
+        params = faiss.SearchParameters(sel=sel)
+    elif isinstance(base, faiss.IndexIVFFlat):
+        params = faiss.SearchParametersIVF(sel=sel)
+        params.nprobe = base.nlist
+    else:
+        return None
+    return base.search(query, k, params=params)
+
+# ====== 6. 再採点（圧縮インデックス用） ======
+def fetch_stored_vectors(conn: sqlite3.Connection, vec_indexes) -> Dict[int, np.ndarray]:
+    ids = [int(v) for v in vec_indexes]
+    if not ids:
+        return {}
+    rows = conn.execute(
+        "SELECT vec_index, vector FROM vector_metadata WHERE vec_index IN (SELECT value FROM json_each(?))",
+        (json.dumps(ids),),
+    ).fetchall()
+    return {int(i): np.frombuffer(v, dtype=np.float32) for i, v in rows}
+
+def rescore(query: np.ndarray, ids: np.ndarray, stored: Dict[int, np.ndarray], k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """近似検索の候補を float ベクトルとの内積で並べ直し、上位 k 件を (D, I) 形式で返す"""
+    cand = [int(i) for i in ids if int(i) in stored]
+    if not cand:
+        return np.zeros((1, 0), dtype=np.float32), np.zeros((1, 0), dtype=np.int64)
+    scores = np.vstack([stored[i] for i in cand]) @ query.reshape(-1)
+    order = np.argsort(-scores, kind="stable")[:k]
+    return scores[order].reshape(1, -1).astype(np.float32), np.asarray(cand, dtype=np.int64)[order].reshape(1, -1)
+
+# ====== 7. vector_metadata スキーマ移行 ======
+def migrate_vector_metadata(conn: sqlite3.Connection, legacy_backend: Optional[str] = None) -> None:
+    """
+    追加列と索引を用意し、未設定の行を埋める（make_vector_*.py / delete_vector.py が接続直後に呼ぶ）
+    ・mtime   : 絞り込み検索用の元ファイル更新日時
+    ・backend : ベクトルを作った埋め込みバックエンド（embedding_backend.py の name）
+    legacy_backend: backend 列導入前の行に入れる値（従来の PyTorch モデル）
+    """
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(vector_metadata)")}
+    if "mtime" not in columns:
+        conn.execute("ALTER TABLE vector_metadata ADD COLUMN mtime REAL")
+    if "backend" not in columns:
+        conn.execute("ALTER TABLE vector_metadata ADD COLUMN backend TEXT")
+    # type / path 前方一致 / mtime 範囲 → vec_index を索引だけで引く（ベクトルBLOBを読まない）
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vector_metadata_filter ON vector_metadata (type, path, mtime)")
+    # 文書単位の重心計算・文書→チャンクの展開用
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vector_metadata_uid ON vector_metadata (uid)")
+    paths = [r[0] for r in conn.execute("SELECT DISTINCT path FROM vector_metadata WHERE mtime IS NULL")]
+    if paths:
+        conn.executemany(
+            "UPDATE vector_metadata SET mtime=? WHERE path=? AND mtime IS NULL",
+            [(get_source_mtime(p), p) for p in paths],
+        )
+        print(f"[INFO] vector_metadata.mtime 補完: {len(paths)} ファイル")
+    if legacy_backend:
+        updated = conn.execute(
+            "UPDATE vector_metadata SET backend=? WHERE backend IS NULL", (legacy_backend,)
+        ).rowcount
+        if updated:
+            print(f"[INFO] vector_metadata.backend 補完: {updated} 件 → {legacy_backend}")
+    conn.commit()
+
+def stored_backends(conn: sqlite3.Connection) -> Dict[str, int]:
+    """保存済みベクトルの埋め込みバックエンド別件数"""
+    return {
+        (name or "unknown"): int(n)
+        for name, n in conn.execute("SELECT backend, COUNT(*) FROM vector_metadata GROUP BY backend")
+    }
+
+def backend_label(sqlite_path: Path) -> str:
+    """index.meta.json の embedding_backend に書く値（混在していれば mixed:...）"""
+    with sqlite3.connect(str(sqlite_path)) as conn:
+        names = sorted(stored_backends(conn))
+    if len(names) == 1:
+        return names[0]
+    return "mixed:" + ",".join(names) if names else ""
+
+# ====== 8. 文書単位インデックス（uid ごとの重心） ======
+DOC_SCHEMA = """
+CREATE TABLE IF NOT EXISTS doc_centroids (
+    doc_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    uid TEXT NOT NULL UNIQUE,
+    path TEXT NOT NULL,
+    type TEXT NOT NULL,
+    n_chunks INTEGER NOT NULL,
+    vector BLOB NOT NULL
+);
+"""
+
+def doc_index_path(index_path: Path) -> Path:
+    return Path(index_path).with_name(DOC_INDEX_NAME)
+
+def update_doc_centroids(conn: sqlite3.Connection) -> Tuple[int, int]:
+    """
+    vector_metadata と突き合わせ、消えた uid の重心を削除し、新しい uid の重心（チャンクの平均をL2正規化）を追加する
+    uid はファイル内容ごとに変わるため、既存 uid の重心は作り直さない。戻り値: (追加, 削除)
+    """
+    conn.executescript(DOC_SCHEMA)
+    removed = conn.execute(
+        "DELETE FROM doc_centroids WHERE uid NOT IN (SELECT uid FROM vector_metadata)"
+    ).rowcount
+    new_uids = [r[0] for r in conn.execute(
+        "SELECT DISTINCT uid FROM vector_metadata WHERE uid NOT IN (SELECT uid FROM doc_centroids)"
+    )]
+    for uid in new_uids:
+        rows = conn.execute("SELECT path, type, vector FROM vector_metadata WHERE uid=?", (uid,)).fetchall()
+        centroid = np.mean([np.frombuffer(v, dtype=np.float32) for _, _, v in rows], axis=0)
+        centroid /= max(float(np.linalg.norm(centroid)), 1e-12)
+        conn.execute(
+            "INSERT INTO doc_centroids (uid, path, type, n_chunks, vector) VALUES (?, ?, ?, ?, ?)",
+            (uid, rows[0][0], rows[0][1], len(rows), sqlite3.Binary(centroid.astype(np.float32).tobytes())),
+        )
+    conn.commit()
+    return len(new_uids), removed
+
+def write_doc_index(sqlite_path: Path, index_path: Path) -> int:
+    """
+    doc_centroids を更新し、doc_index.faiss（文書数ぶんの flat、ID = doc_id）を書き直す
+    検索API が新しい世代で読み直すよう、index.meta.json の世代を進める前に呼ぶ。戻り値: 文書数
+    """
+    with sqlite3.connect(str(sqlite_path)) as conn:
+        added, removed = update_doc_centroids(conn)
+        rows = conn.execute("SELECT doc_id, vector FROM doc_centroids").fetchall()
+    path = doc_index_path(index_path)
+    if not rows:
+        if path.exists():
+            path.unlink()
+        return 0
+    vectors = np.vstack([np.frombuffer(v, dtype=np.float32) for _, v in rows])
+    index = faiss.IndexIDMap(faiss.IndexFlatIP(vectors.shape[1]))
+    index.add_with_ids(vectors, np.asarray([d for d, _ in rows], dtype=np.int64))
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    faiss.write_index(index, str(tmp_path))
+    os.replace(tmp_path, path)
+    print(f"[INFO] 文書インデックス: {len(rows)} 文書（追加 {added} / 削除 {removed}）")
+    return len(rows)
@@ -3,6 +3,7 @@ import json
 import subprocess
 from pathlib import Path
 from uid_utils import read_jsonl, write_jsonl_atomic_sync, rebuild_chunk_log_fast, load_uid_index_map
+from chunk_store import sync_from_jsonl
 
 # === パス設定 ===
 ROOT = Path("/mydata/llm/vector")
@@ -74,6 +75,7 @@ def main():
     if not any(categorized.values()):
         print("[INFO] チャンク生成対象なし")
         rebuild_chunk_log_fast(CHUNK_DIR, CHUNK_LOG)
+        sync_from_jsonl(CHUNK_DIR)
         print("✅ generate_chunk 完了")
         return
 
@@ -88,6 +90,7 @@ def main():
         invoke_script(script_path)
 
     rebuild_chunk_log_fast(CHUNK_DIR, CHUNK_LOG)
+    sync_from_jsonl(CHUNK_DIR)
     print("✅ generate_chunk 完了")
 
 if __name__ == "__main__":
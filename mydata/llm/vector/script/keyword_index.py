@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+keyword_index.py
+チャンク本文の文字bigram転置インデックス（SQLite FTS5 + BM25）
+形態素解析なしで、日本語キーワードの完全一致検索をコーパス全体に対して行う
+索引はチャンクストア（chunk_store.sqlite3）内に置き、chunk_store.replace_file が更新する
+"""
+
+import re
+import json
+import sqlite3
+import unicodedata
+from typing import List, Tuple, Iterable, Dict, Any, Optional
+
+NGRAM = 2
+GRAM_CHARS = re.compile(r"[0-9a-zぁ-んァ-ヶー一-龥々〆]+")
+
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS chunk_fts USING fts5(
+    grams,
+    content='',
+    tokenize='unicode61 remove_diacritics 0'
+);
+"""
+
+# ====== 1. 文字n-gram ======
+def to_grams(text: str, n: int = NGRAM) -> List[str]:
+    """NFKC・小文字化した文字列を、かな漢字英数の連続ごとに n-gram へ分割"""
+    grams: List[str] = []
+    for run in GRAM_CHARS.findall(unicodedata.normalize("NFKC", text).lower()):
+        if len(run) <= n:
+            grams.append(run)
+        else:
+            grams.extend(run[i:i + n] for i in range(len(run) - n + 1))
+    return grams
+
+def grams_text(text: str) -> str:
+    return " ".join(to_grams(text))
+
+# ====== 2. 索引の更新 ======
+def has_schema(conn: sqlite3.Connection) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='chunk_fts'"
+    ).fetchone() is not None
+
+def ensure_schema(conn: sqlite3.Connection) -> bool:
+    """
+    索引テーブルを用意する。新規作成した場合 True（呼び出し側で既存チャンクを投入）
+    トランザクション内で呼べるよう executescript（先に COMMIT する）は使わない
+    """
+    exists = has_schema(conn)
+    conn.execute(SCHEMA)
+    return not exists
+
+def index_chunks(conn: sqlite3.Connection, rows: Iterable[Tuple[int, str]]) -> None:
+    conn.executemany(
+        "INSERT INTO chunk_fts (rowid, grams) VALUES (?, ?)",
+        ((cid, grams_text(text)) for cid, text in rows),
+    )
+
+def unindex_chunks(conn: sqlite3.Connection, rows: Iterable[Tuple[int, str]]) -> None:
+    """contentless FTS5 は登録時と同じ grams を渡して削除する（本文から再計算）"""
+    conn.executemany(
+        "INSERT INTO chunk_fts (chunk_fts, rowid, grams) VALUES ('delete', ?, ?)",
+        ((cid, grams_text(text)) for cid, text in rows),
+    )
+
+# ====== 3. 検索 ======
+def build_match(keywords: Iterable[str]) -> str:
+    """キーワードごとに bigram の連続（＝部分文字列の完全一致）をフレーズとし、OR で結ぶ"""
+    phrases = []
+    for kw in keywords:
+        grams = to_grams(kw)
+        if not grams or (len(grams) == 1 and len(grams[0]) < NGRAM):
+            continue
+        phrase = '"' + " ".join(g.replace('"', '""') for g in grams) + '"'
+        if phrase not in phrases:
+            phrases.append(phrase)
+    return " OR ".join(phrases)
+
+def search(
+    conn: sqlite3.Connection, keywords: List[str], types: Iterable[str], k: int,
+    path_prefix: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """BM25 上位 k 件（types で種別、path_prefix でパス前方一致を絞る）。score が大きいほど良い"""
+    match = build_match(keywords)
+    if not match:
+        return []
+    # 前方一致は範囲比較にする（LIKE だと % や _ を含むパスでずれる）
+    lo, hi = (path_prefix, path_prefix + "\U0010ffff") if path_prefix else ("", "\U0010ffff")
+    # 順位付けは (rowid, score) だけで行い、本文は上位 k 件だけ結合する（本文ごと並べ替えない）
+    rows = conn.execute(
+        """
+        SELECT c.path, c.chunk_index, c.uid, c.type, c.text, r.s
+        FROM (
+            SELECT chunk_fts.rowid AS id, bm25(chunk_fts) AS s
+            FROM chunk_fts
+            JOIN chunks AS m ON m.id = chunk_fts.rowid
+            WHERE chunk_fts MATCH ?
+              AND m.type IN (SELECT value FROM json_each(?))
+              AND m.path >= ? AND m.path < ?
+            ORDER BY s
+            LIMIT ?
+        ) AS r
+        JOIN chunks AS c ON c.id = r.id
+        ORDER BY r.s
+        """,
+        (match, json.dumps(list(types)), lo, hi, int(k)),
+    ).fetchall()
+    return [
+        {"path": p, "chunk_index": int(i), "uid": u, "type": t, "text": text, "bm25": -float(s)}
+        for p, i, u, t, text, s in rows
+    ]
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+keyword_matcher.py
+複数キーワードの一括照合（Aho–Corasick）
+キーワードをまとめて1つのオートマトンにし、本文を1回走査するだけで
+含まれるキーワードの集合を得る（main.py の再ランキング／make_chunk_excel.py の分類で共用）
+キーワードが少ないうちは str の部分一致（C実装）を並べた方が速いため、
+AC_MIN_PATTERNS 未満、または pyahocorasick（C拡張）がない環境では部分一致で照合する
+"""
+
+import os
+from typing import Iterable, List, Set
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+AC_MIN_PATTERNS = int(os.getenv("AC_MIN_PATTERNS", "16"))
+
+class KeywordMatcher:
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns: List[str] = list(dict.fromkeys(p for p in patterns if p))
+        self._automaton = None
+        if ahocorasick is not None and len(self.patterns) >= AC_MIN_PATTERNS:
+            self._automaton = ahocorasick.Automaton()
+            for p in self.patterns:
+                self._automaton.add_word(p, p)
+            self._automaton.make_automaton()
+
+    def matches(self, text: str) -> Set[str]:
+        """text に含まれるキーワードの集合"""
+        if not text:
+            return set()
+        if self._automaton is not None:
+            return {p for _, p in self._automaton.iter(text)}
+        return {p for p in self.patterns if p in text}
+
+    def __bool__(self) -> bool:
+        return bool(self.patterns)
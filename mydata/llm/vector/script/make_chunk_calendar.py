@@ -6,6 +6,7 @@ from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from uid_utils import generate_chunk_index  # ✅ インデックス付番用
+from chunk_store import write_chunk_file
 
 TEXT_ROOT = Path("/mydata/llm/vector/db/text")
 CHUNK_DIR = Path("/mydata/llm/vector/db/chunk")
@@ -33,6 +34,7 @@ def process_file(txt_path: Path, uid: str, ftype: str):
     with open(out_path, "w", encoding="utf-8") as f:
         f.write(json.dumps(record, ensure_ascii=False) + "\n")
 
+    write_chunk_file(rel_path, [record], out_path)
     return 1
 
 def main():
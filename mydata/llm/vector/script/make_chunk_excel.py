@@ -7,6 +7,8 @@ from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from uid_utils import generate_chunk_index  # ✅ インデックス付番用
+from chunk_store import write_chunk_file
+from keyword_matcher import KeywordMatcher  # ✅ 分類語の一括照合
 
 TEXT_ROOT = Path("/mydata/llm/vector/db/text")
 CHUNK_DIR = Path("/mydata/llm/vector/db/chunk")
@@ -17,19 +19,27 @@ SHEET_PATTERN = re.compile(r"<<sheet:(.*?)>>")
 # ✅ MAX-2対応
 MAX_WORKERS = max(1, os.cpu_count() - 2)
 
+# 分類語（上から順に判定）。全語を1つのマッチャーにまとめ、本文は1回だけ走査する
+CLASSIFY_RULES = [
+    ("task", ["連絡する", "提出予定", "依頼", "やること", "すること", "申請する"]),
+    ("done", ["連絡済", "提出した", "送った", "した", "完了", "済", "受領"]),
+    ("status", ["未了", "未済", "未提出", "控", "要対応", "未", "要送付"]),
+    ("expense", ["費", "報酬", "給与", "振込", "入金", "出金", "支払", "経費", "利息"]),
+]
+CONTACT_WORDS = ["電話", "fax", "〒", "住所", "tel"]
+DIGITS = list("0123456789")
+CLASSIFY_MATCHER = KeywordMatcher(
+    CONTACT_WORDS + DIGITS + ["-"] + [w for _, words in CLASSIFY_RULES for w in words]
+)
+KEYWORD_MATCHER = KeywordMatcher(["FAX", "住所"])
+
 def classify_text(text: str) -> str:
-    text = text.lower()
-    if "電話" in text or "fax" in text or "〒" in text or "住所" in text \
-        or any(x in text for x in ["tel", "fax"]) or (any(c in text for c in "0123456789") and "-" in text):
+    found = CLASSIFY_MATCHER.matches(text.lower())
+    if not found.isdisjoint(CONTACT_WORDS) or (not found.isdisjoint(DIGITS) and "-" in found):
         return "contact"
-    if any(w in text for w in ["連絡する", "提出予定", "依頼", "やること", "すること", "申請する"]):
-        return "task"
-    if any(w in text for w in ["連絡済", "提出した", "送った", "した", "完了", "済", "受領"]):
-        return "done"
-    if any(w in text for w in ["未了", "未済", "未提出", "控", "要対応", "未", "要送付"]):
-        return "status"
-    if any(w in text for w in ["費", "報酬", "給与", "振込", "入金", "出金", "支払", "経費", "利息"]):
-        return "expense"
+    for label, words in CLASSIFY_RULES:
+        if not found.isdisjoint(words):
+            return label
     return "memo"
 
 def extract_keywords(text: str) -> str:
@@ -42,9 +52,10 @@ def extract_keywords(text: str) -> str:
         keywords.append("日付")
     if re.search(r"\d{1,3}(,\d{3})+円|\d+円", text):
         keywords.append("金額")
-    if "FAX" in text.upper():
+    found = KEYWORD_MATCHER.matches(text.upper())
+    if "FAX" in found:
         keywords.append("FAX")
-    if "住所" in text:
+    if "住所" in found:
         keywords.append("住所")
     return "・".join(keywords)
 
@@ -96,6 +107,7 @@ def process_file(txt_path: Path, uid: str, ftype: str):
         for c in chunks:
             f.write(json.dumps(c, ensure_ascii=False) + "\n")
 
+    write_chunk_file(rel_path, chunks, out_path)
     return len(chunks)
 
 def main():
@@ -7,6 +7,7 @@ from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from uid_utils import generate_chunk_index
+from chunk_store import write_chunk_file
 
 TEXT_ROOT = Path("/mydata/llm/vector/db/text")
 CHUNK_DIR = Path("/mydata/llm/vector/db/chunk")
@@ -43,6 +44,7 @@ def process_file(txt_path: Path, uid: str, ftype: str):
     out_path = CHUNK_DIR / (rel_path + ".jsonl")
     out_path.parent.mkdir(parents=True, exist_ok=True)
 
+    records = []
     with open(out_path, "w", encoding="utf-8") as f:
         for i, c in enumerate(body_chunks):
             record = {
@@ -53,7 +55,9 @@ def process_file(txt_path: Path, uid: str, ftype: str):
                 "text": c
             }
             f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            records.append(record)
 
+    write_chunk_file(rel_path, records, out_path)
     return len(body_chunks)
 
 def main():
@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
-import os
 import json
 import sqlite3
-import faiss
 import numpy as np
 from pathlib import Path
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
-from sentence_transformers import SentenceTransformer
+
+from faiss_utils import (
+    write_index_atomic, read_index_meta, load_group_config, rebuild_index_from_sqlite, layout_matches,
+    read_index_for_update, write_doc_index, doc_index_path, bump_generation,
+    migrate_vector_metadata, stored_backends, backend_label,
+)
+from embedding_backend import load_backend_from_config
+from uid_utils import get_source_mtime
 
 # === 設定 ===
 ROOT = Path("/mydata/llm/vector")
@@ -15,16 +19,16 @@ CHUNK_DIR = ROOT / "db/chunk"
 CHUNK_LOG = ROOT / "db/log/chunk_log.jsonl"
 SQLITE_PATH = ROOT / "db/faiss/pdf_word/metadata.sqlite3"
 FAISS_PATH = ROOT / "db/faiss/pdf_word/index.faiss"
-MODEL_PATH = "/mydata/llm/vector/models/legal-bge-m3"
+GROUP_CONFIG = load_group_config("pdf_word")
 
-model = SentenceTransformer(MODEL_PATH)
-VECTOR_DIM = model.get_sentence_embedding_dimension()
-THREAD_WORKERS = max(1, os.cpu_count() - 2)
+backend = load_backend_from_config(GROUP_CONFIG)  # torch / onnx / gguf
+VECTOR_DIM = backend.dim
 BATCH_CHUNK_SIZE = 500
-TIMEOUT_SEC = 300
+ENCODE_BATCH_SIZE = 32
 
 def init_sqlite():
     with sqlite3.connect(SQLITE_PATH) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")  # 検索APIの読み取りと書き込みを並行させる
         conn.execute("""
             CREATE TABLE IF NOT EXISTS vector_metadata (
                 vec_index INTEGER PRIMARY KEY,
@@ -35,6 +39,9 @@ def init_sqlite():
                 vector BLOB NOT NULL
             )
         """)
+        # キーワード検索のヒット（path, chunk_index）から vec_index / vector を引くため
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_vector_metadata_path ON vector_metadata (path, chunk_index)")
+        migrate_vector_metadata(conn, legacy_backend=f"torch:{Path(GROUP_CONFIG['embedding_model']).name}")
 
 def get_existing_uids_from_db():
     if not SQLITE_PATH.exists():
@@ -88,29 +95,54 @@ def load_chunk_texts(target_chunks):
     return enriched
 
 def encode_batch(texts):
-    return model.encode(
-        texts,
-        convert_to_numpy=True,
-        normalize_embeddings=True
-    ).tolist()
+    return backend.encode(texts, batch_size=ENCODE_BATCH_SIZE)
 
 def insert_to_sqlite(start_index, metas, embeddings):
     with sqlite3.connect(SQLITE_PATH) as conn:
         cur = conn.cursor()
+        mtimes = {}
         for offset, (meta, vec) in enumerate(zip(metas, embeddings)):
+            if meta["path"] not in mtimes:
+                mtimes[meta["path"]] = get_source_mtime(meta["path"])
             cur.execute(
-                "INSERT INTO vector_metadata VALUES (?, ?, ?, ?, ?, ?)",
+                "INSERT INTO vector_metadata (vec_index, uid, chunk_index, path, type, vector, mtime, backend) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
                 (
                     start_index + offset,
                     meta["uid"],
                     meta["index"],
                     meta["path"],
                     meta["type"],
-                    sqlite3.Binary(np.array(vec, dtype=np.float32).tobytes())
+                    sqlite3.Binary(np.array(vec, dtype=np.float32).tobytes()),
+                    mtimes[meta["path"]],
+                    backend.name,
                 )
             )
         conn.commit()
 
+def rebuild_if_config_changed():
+    """新規登録がなくても、設定の種別（flat / ivf / hnsw）・次元削減と既存インデックスが違えば作り直す"""
+    if not FAISS_PATH.exists():
+        return
+    index_conf = GROUP_CONFIG["index"]
+    meta = read_index_meta(FAISS_PATH)
+    current_type = meta.get("index_type", "flat")
+    if layout_matches(meta, index_conf, VECTOR_DIM, int(meta.get("ntotal", 0))):
+        return
+    index, index_params = rebuild_index_from_sqlite(SQLITE_PATH, index_conf)
+    if index is None:
+        return
+    write_index_atomic(index, FAISS_PATH, **{**index_params, "embedding_backend": backend_label(SQLITE_PATH)})
+    print(
+        f"[INFO] FAISS種別変更: {current_type} → {index_params['index_type']}"
+        f"（次元削減: {index_params.get('reduce', 'none')} / {index.ntotal}件）"
+    )
+
+def ensure_doc_index():
+    """文書インデックス導入前のグループ → 保存済みベクトルから作る"""
+    if FAISS_PATH.exists() and not doc_index_path(FAISS_PATH).exists():
+        write_doc_index(SQLITE_PATH, FAISS_PATH)
+        bump_generation(FAISS_PATH)
+
 def main():
     print("▶️ make_vector_pdf_word 開始（ログなし高速版）")
     init_sqlite()
@@ -125,40 +157,55 @@ def main():
 
     if not target_chunks_meta:
         print("✅ 新規登録対象なし")
+        rebuild_if_config_changed()
+        ensure_doc_index()
         return
 
     target_chunks = load_chunk_texts(target_chunks_meta)
-    print(f"[INFO] 登録対象チャンク数: {len(target_chunks)} 件")
+    print(f"[INFO] 登録対象チャンク数: {len(target_chunks)} 件（埋め込み: {backend.name}）")
+    with sqlite3.connect(SQLITE_PATH) as conn:
+        others = {k: n for k, n in stored_backends(conn).items() if k != backend.name}
+    if others:
+        print(f"⚠️ 別のバックエンドで作ったベクトルと混在します: {others}（揃えるには再ベクトル化が必要）")
 
+    index_conf = GROUP_CONFIG["index"]
+    index, index_params = None, {}
     if FAISS_PATH.exists():
-        index = faiss.read_index(str(FAISS_PATH))
+        # 次元削減ありなら変換と組で読む（add は元の次元のベクトルのまま）
+        index = read_index_for_update(FAISS_PATH)
         vec_index = index.ntotal
+        index_params = {k: v for k, v in read_index_meta(FAISS_PATH).items() if k not in ("generation", "updated_at", "ntotal")}
+        if not layout_matches(index_params, index_conf, VECTOR_DIM, vec_index + len(target_chunks)):
+            # 設定変更（flat → ivf、次元削減の追加等）または件数が学習可能な規模に達した → 登録後に全件から作り直す
+            index = None
         print(f"[INFO] 既存FAISSあり: {vec_index}件から再開")
     else:
-        index = faiss.IndexFlatIP(VECTOR_DIM)
         vec_index = 0
-        print(f"[INFO] 新規FAISS作成（次元数: {VECTOR_DIM}）")
+        print(f"[INFO] 新規FAISS作成（次元数: {VECTOR_DIM} / 種別: {index_conf['type']}）")
 
     for i in range(0, len(target_chunks), BATCH_CHUNK_SIZE):
         batch = target_chunks[i:i + BATCH_CHUNK_SIZE]
         texts = [c["text"] for c in batch]
         metas = batch
 
+        # metas と同じ順序で埋め込む（ランタイム側がバッチ内で並列化する）
         emb = []
-        with ThreadPoolExecutor(max_workers=THREAD_WORKERS) as ex:
-            futures = [ex.submit(encode_batch, [t]) for t in texts]
-            for f in tqdm(as_completed(futures), total=len(futures),
-                          desc=f"ベクトル生成中({i // BATCH_CHUNK_SIZE + 1}バッチ目)"):
-                try:
-                    emb.extend(f.result(timeout=TIMEOUT_SEC))
-                except TimeoutError:
-                    print("⚠️ タイムアウト発生、スキップ")
-
-        index.add(np.array(emb, dtype=np.float32))
+        for j in tqdm(range(0, len(texts), ENCODE_BATCH_SIZE),
+                      desc=f"ベクトル生成中({i // BATCH_CHUNK_SIZE + 1}バッチ目)"):
+            emb.extend(encode_batch(texts[j:j + ENCODE_BATCH_SIZE]))
+
+        if index is not None:
+            index.add(np.array(emb, dtype=np.float32))
         insert_to_sqlite(vec_index, metas, emb)
         vec_index += len(emb)
 
-    faiss.write_index(index, str(FAISS_PATH))
+    if index is None:
+        # IVF は学習が必要なため、SQLite に保存済みの全ベクトルから作り直す
+        index, index_params = rebuild_index_from_sqlite(SQLITE_PATH, index_conf)
+        print(f"[INFO] FAISS再構築: {index_params.get('index_type')} / {index.ntotal}件")
+
+    write_doc_index(SQLITE_PATH, FAISS_PATH)
+    write_index_atomic(index, FAISS_PATH, **{**index_params, "embedding_backend": backend_label(SQLITE_PATH)})
     print(f"✅ Vector登録完了: 新規登録 {len(target_chunks)} 件 / 総計 {len(all_chunks)} 件")
 
 if __name__ == "__main__":
@@ -10,7 +10,7 @@ import json
 import hashlib
 import orjson
 from pathlib import Path
-from typing import List, Dict, Any, Set
+from typing import List, Dict, Any, Set, Optional
 
 # ====== 1. UID生成（テキスト用・一元管理） ======
 def generate_uid(file_path: Path) -> str:
@@ -43,6 +43,20 @@ def write_jsonl_atomic_sync(path: Path, data: List[Dict[str, Any]]) -> None:
 def get_relative_path(file_path: Path, base_path: Path) -> str:
     return str(file_path.relative_to(base_path)).replace("\\", "/")
 
+NAS_ROOT = Path("/mydata/nas")
+TEXT_ROOT = Path("/mydata/llm/vector/db/text")
+
+def get_source_mtime(rel_path: str) -> Optional[float]:
+    """チャンクの path（テキストの相対パス）→ 元ファイルの更新日時（UNIX秒）。元ファイルがなければテキストの更新日時"""
+    candidates = [NAS_ROOT / rel_path[:-len(".txt")]] if rel_path.endswith(".txt") else []
+    candidates.append(TEXT_ROOT / rel_path)
+    for path in candidates:
+        try:
+            return path.stat().st_mtime
+        except OSError:
+            continue
+    return None
+
 # ====== 5. 汎用ヘルパー ======
 def ensure_dir_exists(path: Path) -> None:
     path.mkdir(parents=True, exist_ok=True)
@@ -0,0 +1,62 @@
+import sys
+from pathlib import Path
+
+import faiss
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "script"))
+from faiss_utils import read_index, search_ids_exact
+
+DIM = 32
+
+def _vectors() -> np.ndarray:
+    return np.random.default_rng(0).standard_normal((2000, DIM)).astype(np.float32)
+
+def _write(tmp_path: Path, factory: str) -> Path:
+    vectors = _vectors()
+    index = faiss.index_factory(DIM, factory, faiss.METRIC_INNER_PRODUCT)
+    index.train(vectors)
+    index.add(vectors)
+    path = tmp_path / "index.faiss"
+    faiss.write_index(index, str(path))
+    return path
+
+@pytest.mark.parametrize("factory", ["IVF16,Flat", "IVF16,SQ8", "IVF16,PQ8"])
+def test_ivf_index_is_mmapped(tmp_path, factory):
+    path = _write(tmp_path, factory)
+    index, mode = read_index(path, mmap=True)
+    assert mode == "ondisk"
+    ivf = faiss.extract_index_ivf(index)
+    assert isinstance(faiss.downcast_InvertedLists(ivf.invlists), faiss.OnDiskInvertedLists)
+
+    loaded, _ = read_index(path)
+    query = np.ones((1, DIM), dtype=np.float32)
+    ivf.nprobe = faiss.extract_index_ivf(loaded).nprobe = 16
+    assert (index.search(query, 10)[1] == loaded.search(query, 10)[1]).all()
+
+def test_flat_index_is_mmapped_in_place(tmp_path):
+    index, mode = read_index(_write(tmp_path, "Flat"), mmap=True)
+    assert mode == "ifc"
+    assert index.ntotal == 2000
+
+def test_mmap_disabled_reads_into_memory(tmp_path):
+    _, mode = read_index(_write(tmp_path, "IVF16,Flat"))
+    assert mode == ""
+
+@pytest.mark.parametrize("factory", ["Flat", "IVF16,Flat", "HNSW16"])
+def test_search_ids_exact_matches_brute_force(tmp_path, factory):
+    index, _ = read_index(_write(tmp_path, factory), mmap=True)
+    ids = np.arange(0, 2000, 7, dtype=np.int64)
+    query = np.ones((1, DIM), dtype=np.float32)
+    D, I = search_ids_exact(index, query, ids, 10)
+    scores = _vectors()[ids] @ query[0]
+    expected = ids[np.argsort(-scores)[:10]]
+    assert (I[0] == expected).all()
+    assert np.allclose(D[0], np.sort(scores)[::-1][:10], atol=1e-4)
+
+@pytest.mark.parametrize("factory", ["SQ8", "IVF16,PQ8"])
+def test_search_ids_exact_skips_compressed(tmp_path, factory):
+    index, _ = read_index(_write(tmp_path, factory), mmap=True)
+    ids = np.arange(10, dtype=np.int64)
+    assert search_ids_exact(index, np.ones((1, DIM), dtype=np.float32), ids, 5) is None